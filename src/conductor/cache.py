@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """A dictionary-like cache holding at most maxsize entries, evicting the least recently used.
+    
+    A maxsize of None leaves the cache unbounded, and a maxsize of 0 disables it. Cache hits,
+    misses and evictions are counted, and reported by stats(). The cache is safe to share between
+    threads.
+    
+    """
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, key):
+        return key in self.entries
+    
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            
+            self.entries[key] = value
+            self.hits += 1
+            return value
+    
+    def put(self, key, value):
+        if self.maxsize == 0:
+            return
+        
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if self.maxsize is not None:
+                while len(self.entries) > self.maxsize:
+                    self._evicted(*self.entries.popitem(last=False))
+                    self.evictions += 1
+    
+    def _evicted(self, key, value):
+        """Called with each entry evicted to make room for another."""
+        pass
+    
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        
+    def stats(self):
+        return {"size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
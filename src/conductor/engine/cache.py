@@ -0,0 +1,92 @@
+from ..cache import LRUCache
+
+class SourceCache(LRUCache):
+    """Caches values computed for each source track id (None for the start of a session).
+    
+    Along with each value, the cache keeps the field values of its source track, so that when a
+    chain edge leaving a given field value changes, only the affected sources are invalidated.
+    The sources are indexed by each of their field values, so that invalidation takes time
+    proportional to the number of affected sources. Every entry is dropped when a new entry is
+    added to the catalog.
+    
+    Values may be computed from data that changes meanwhile, e.g. from an older snapshot of the
+    database. The generation is incremented whenever entries are invalidated or cleared; a value
+    is only cached if the generation has not moved since it started to be computed.
+    
+    """
+    def __init__(self, musicdb, maxsize=None):
+        LRUCache.__init__(self, maxsize)
+        self.musicdb = musicdb
+        self.catalog_version = musicdb.catalog_version
+        self.generation = 0
+        
+        # Cached source track ids by (field, value) pair, or by None for the start of a session
+        self.sources = {}
+    
+    def _check_catalog(self):
+        version = self.musicdb.catalog_version
+        if self.catalog_version != version:
+            self.clear()
+            self.catalog_version = version
+    
+    def get(self, fromid):
+        self._check_catalog()
+        entry = LRUCache.get(self, fromid)
+        if entry:
+            return entry[1]
+    
+    def put(self, fromid, fields, value, generation=None):
+        """Cache a value for a source track, given a dictionary of the track's field values.
+        
+        generation is that of the cache before the value was computed; the value is dropped if
+        entries have been invalidated since.
+        
+        """
+        self._check_catalog()
+        if self.maxsize == 0:
+            return
+        
+        with self.lock:
+            if generation is None or generation == self.generation:
+                self.discard(fromid)
+                for key in self._keys(fields):
+                    self.sources.setdefault(key, set()).add(fromid)
+                LRUCache.put(self, fromid, (fields, value))
+    
+    def _keys(self, fields):
+        if fields is None:
+            return [None]
+        return fields.items()
+    
+    def _unindex(self, fromid, fields):
+        for key in self._keys(fields):
+            fromids = self.sources[key]
+            fromids.discard(fromid)
+            if not fromids:
+                del self.sources[key]
+    
+    def _evicted(self, fromid, entry):
+        self._unindex(fromid, entry[0])
+    
+    def discard(self, fromid):
+        with self.lock:
+            entry = self.entries.pop(fromid, None)
+            if entry is not None:
+                self._unindex(fromid, entry[0])
+    
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.sources.clear()
+            LRUCache.clear(self)
+        
+    def invalidate(self, field, value):
+        """Drop the entries of every source track with the given field value.
+        
+        The start of a session is matched by a field value of -1, as in the chain tables.
+        
+        """
+        with self.lock:
+            self.generation += 1
+            for fromid in list(self.sources.get(None if value == -1 else (field, value), ())):
+                self.discard(fromid)
@@ -0,0 +1,67 @@
+import logging
+import heapq
+
+from cache import SourceCache
+from sampler import AliasTable
+from weights import batch_weight_function
+
+_log = logging.getLogger("conductor.candidates")
+
+class CandidateIndex(SourceCache):
+    """Materializes the likeliest tracks to follow each source track, for picks in constant time.
+    
+    Only the tracks matched by a chain edge leaving a source track score differently from the
+    default; of those, the count best tracks scoring above the default are kept as its candidates.
+    A pick samples from the candidates, except with the exploration probability (or when there are
+    no candidates), when it picks a track uniformly from the whole catalog instead.
+    
+    Entries are invalidated along with the other caches as transitions are scored, and rebuilt on
+    the next pick in time proportional to the number of matched tracks.
+    
+    """
+    def __init__(self, conductor, model, count, exploration, maxsize=None):
+        SourceCache.__init__(self, conductor.musicdb, maxsize)
+        self.conductor = conductor
+        self.model = model
+        self.count = count
+        self.exploration = exploration
+    
+    def sample(self, fromid, rng):
+        table = self.get(fromid)
+        if table is None:
+            generation = self.generation
+            table = self._build(fromid)
+            self.put(fromid, self.conductor._get_source_fields(fromid), table, generation)
+        
+        if table and rng.random() >= self.exploration:
+            return table.sample(rng)
+        
+        ids = self.model.catalog.ids
+        if not self.model.indexed:
+            raise ValueError("Cannot pick a track from an empty catalog.")
+        return int(ids[rng.randrange(self.model.indexed)])
+    
+    def _build(self, fromid):
+        """Build an alias table over the candidates to follow a track (False if there are none)."""
+        conductor = self.conductor
+        adjusted = self.model.get_adjustments(fromid, conductor.chains.values(), conductor.config)
+        if not adjusted:
+            return False
+        base_score, base_userscore, adjustments = adjusted
+        
+        trackids = adjustments.keys()
+        scores = [base_score] + [base_score + adjustments[trackid][0] for trackid in trackids]
+        userscores = [base_userscore] + [base_userscore + adjustments[trackid][1] for trackid in trackids]
+        weights = batch_weight_function(conductor.config["weight_function"])(conductor, scores, userscores)
+        if hasattr(weights, "tolist"):
+            weights = weights.tolist()
+        
+        # The first weight is that of every track without a matching edge
+        base_weight = weights[0]
+        best = heapq.nlargest(self.count, ((weight, trackid) for weight, trackid in zip(weights[1:], trackids)
+                                           if weight > base_weight))
+        
+        _log.debug("Built %s candidates to follow track id %s.", len(best), fromid)
+        if not best:
+            return False
+        return AliasTable(dict((trackid, weight) for weight, trackid in best))
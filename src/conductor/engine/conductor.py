@@ -1,12 +1,59 @@
 import logging
+import datetime
 _log = logging.getLogger("conductor.conductor")
 
 from ..musicdb import MusicDB, Track
 
-class Conductor:
-    def __init__(self, dbpath):
-        self.musicdb = MusicDB(dbpath)
+class Session:
+    """The playback state of a single listener.
+    
+    Any number of sessions can share one conductor (and its loaded model). Each session remembers
+    its own last transition and the id of its history entry, so that feedback is applied to the
+    right transition directly by primary key.
+    
+    """
+    def __init__(self, conductor):
+        self.conductor = conductor
         self.last_transition = None
+        self.historyid = None
+    
+    @property
+    def current_track(self):
+        if self.last_transition:
+            return self.last_transition[1]
+    
+    def record_transition(self, fromtrack, totrack, userchoice=True):
+        """Called when a track transition occurs in this session."""
+        fromtrack, totrack = self.conductor._lookup_tracks(fromtrack, totrack)
+        self.historyid = self.conductor._record_transition(fromtrack, totrack, userchoice)
+        self.last_transition = (fromtrack, totrack)
+    
+    def record_user_feedback(self, liked):
+        """Called when the listener likes or dislikes the last transition of this session."""
+        if not self.last_transition:
+            raise ValueError("No transition has been recorded in this session.")
+        self.conductor._record_user_feedback(self.last_transition, self.historyid, liked)
+    
+    def choose_next_track(self, fromtrack=None):
+        """Choose the track to follow the given track (by default, the last track of this session)."""
+        if fromtrack is None:
+            fromtrack = self.current_track
+        return self.conductor.choose_next_track(fromtrack)
+
+class Conductor:
+    def __init__(self, dbpath, **dboptions):
+        self.musicdb = MusicDB(dbpath, **dboptions)
+        
+        # The session used by the single-listener methods below
+        self.default_session = Session(self)
+    
+    def session(self):
+        """Start a new listening session, with its own playback state."""
+        return Session(self)
+    
+    @property
+    def last_transition(self):
+        return self.default_session.last_transition
     
     def get_track(self, desc):
         if desc:
@@ -14,7 +61,7 @@ class Conductor:
                                           album_name=desc["album"],
                                           artist_name=desc["artist"],
                                           genre_name=desc["genre"],
-                                          add=True)
+                                          add=not self.musicdb.readonly)
 
     def get_desc(self, track):
         return {"title":  track["name"],
@@ -23,21 +70,89 @@ class Conductor:
                 "genre":  track.genre["name"] if track.genre else ""}
             
     def _lookup_tracks(self, *tracks):
-        return [self.get_track(track) for track in tracks 
-                if not isinstance(track, Track)]
+        return [track if isinstance(track, Track) else self.get_track(track)
+                for track in tracks]
             
     def touch_track(self, d):
         """Ensure that the specified track exists within the database."""
         
         _log.info("Touching track \"%s\" from \"%s\" by \"%s\".", d["title"], d["album"], d["artist"])
         self.get_track(d)
+    
+    def touch_tracks(self, descs):
+        """Ensure that many tracks exist within the database at once, returning their ids."""
+        return self.musicdb.bulk_add_tracks(descs)
 
-    def record_transition(self, fromtrack, totrack, userchoice):
+    def record_transition(self, fromtrack, totrack, userchoice=True):
         """Called when a track transition occurs."""
-        totrack.record_play()
-        self.musicdb.history.record_transition(fromtrack.id if fromtrack else None, totrack.id, userchoice)
-        self.last_transition = (fromtrack, totrack)
+        self.default_session.record_transition(fromtrack, totrack, userchoice)
+    
+    def _record_transition(self, fromtrack, totrack, userchoice):
+        """Record a transition between two tracks, returning the id of its history entry."""
+        with self.musicdb.transaction():
+            totrack.record_play()
+            return self.musicdb.history.record_transition(fromtrack.id if fromtrack else None, totrack.id, userchoice)
+    
+    def record_transitions(self, transitions):
+        """Record many track transitions at once, e.g. to import listening history.
+        
+        Accepts an iterable of (fromtrack, totrack, userchoice[, timestamp]) tuples. The result is
+        the same as calling record_transition for each of them in turn, but all of the writes are
+        batched into a single transaction.
+        
+        """
+        transitions = self._resolve_transitions(transitions)
+        if transitions:
+            with self.musicdb.transaction():
+                historyid = self._record_transitions(transitions)
+            self.default_session.last_transition = transitions[-1][1:3]
+            self.default_session.historyid = historyid
+        
+    def _resolve_transitions(self, transitions):
+        """Look up the tracks of many transitions, returning (timestamp, fromtrack, totrack, userchoice) tuples."""
+        tracks = {}
+        def lookup(desc):
+            if desc is None or isinstance(desc, Track):
+                return desc
+            key = (desc["title"], desc["album"], desc["artist"], desc["genre"])
+            if key not in tracks:
+                tracks[key] = self.get_track(desc)
+            return tracks[key]
+        
+        resolved = []
+        last_timestamp = None
+        for transition in transitions:
+            fromtrack, totrack, userchoice = transition[:3]
+            if len(transition) > 3:
+                timestamp = transition[3]
+            else:
+                # Generated timestamps keep increasing, so that entries sort in the order recorded
+                timestamp = datetime.datetime.now()
+                if last_timestamp and timestamp <= last_timestamp:
+                    timestamp = last_timestamp + datetime.timedelta(microseconds=1)
+                last_timestamp = timestamp
+            resolved.append((timestamp, lookup(fromtrack), lookup(totrack), userchoice))
+        return resolved
+    
+    def _record_transitions(self, transitions):
+        """Record many resolved transitions, returning the history id of the last.
+        
+        This must be called within a transaction.
+        
+        """
+        plays = {}
+        for timestamp, fromtrack, totrack, userchoice in transitions:
+            count, lastplayed = plays.get(totrack.id, (0, timestamp))
+            plays[totrack.id] = (count + 1, max(lastplayed, timestamp))
+        self.musicdb.record_plays(plays)
+        
+        return self.musicdb.history.record_transitions([(timestamp, fromtrack.id if fromtrack else None, totrack.id, userchoice)
+                                                        for timestamp, fromtrack, totrack, userchoice in transitions])
     
     def record_user_feedback(self, liked):
         """Called when a user likes or dislikes a transition."""
-        self.musicdb.history.record_user_feedback(1 if liked else -1)
\ No newline at end of file
+        self.default_session.record_user_feedback(liked)
+    
+    def _record_user_feedback(self, transition, historyid, liked):
+        """Record feedback on a transition, given the id of its history entry."""
+        self.musicdb.history.record_user_feedback(1 if liked else -1, historyid)
\ No newline at end of file
@@ -0,0 +1,19 @@
+import math
+import time
+
+def decay_function(half_life):
+    """Make a function giving the factor by which a score updated at one time has decayed by another.
+    
+    Scores halve every half_life seconds. Scores with no update time are not decayed.
+    
+    """
+    rate = math.log(2) / half_life
+    def decay(updated, now):
+        if updated is None or updated >= now:
+            return 1.0
+        return math.exp(rate * (updated - now))
+    return decay
+
+def epoch_seconds(timestamp):
+    """Convert a local datetime (as recorded in the history) to seconds since the epoch, like time.time()."""
+    return time.mktime(timestamp.timetuple()) + timestamp.microsecond / 1e6
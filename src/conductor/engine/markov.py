@@ -1,64 +1,365 @@
 from __future__ import with_statement
 
+import os
 import logging
 import math
 import random
 import bisect
+import heapq
+import time
+import datetime
+from itertools import izip
+from contextlib import contextmanager
 
 from conductor import Conductor
+from ..musicdb import CatalogTable
+from ..metrics import Metrics, StatsLogger, timed
+from cache import SourceCache
+from candidates import CandidateIndex
+from decay import decay_function, epoch_seconds
+from memory import MemoryModel
+from rebuild import rebuild_chains
+from snapshot import SnapshotModel, write_snapshot
+from sampler import AliasTable
+from weights import batch_weight_function, calculate_weight, calculate_weight_scalar
+from writebehind import WriteBehindQueue, TransitionEvent
 
 _log = logging.getLogger("conductor.markov")
 
-def weighted_choice(weight_dict):
+def weighted_choice(weight_dict, rng=random):
     accum = 0
+    items = []
     choices = []
     for item, weight in weight_dict.iteritems():
         accum += weight
+        items.append(item)
         choices.append(accum)
     
-    rand = random.random() * accum
+    rand = rng.random() * accum
     index = bisect.bisect_right(choices, rand)
     
-    return weight_dict.keys()[index]
+    return items[index]
 
 class MarkovConductor(Conductor):
     def __init__(self, dbpath, config={}):
-        Conductor.__init__(self, dbpath)
-        self.chains = {}
-        
-        # Configuration defaults
-        self.config = {"weight_function": self._calculate_weight,
+        # Configuration defaults; a subclass overriding _calculate_weight keeps it as the default
+        weight_function = calculate_weight
+        if self.__class__._calculate_weight.im_func is not MarkovConductor._calculate_weight.im_func:
+            weight_function = self._calculate_weight
+        self.config = {"weight_function": weight_function,
                        "user_choice_score": 2,
                        "markov_choice_score": 1,
                        "min_score_divisor": 10,
                        "default_score": 0,
                        "default_userscore": 0,
                        "min_userscore": - 5,
-                       "max_userscore": 5}
+                       "max_userscore": 5,
+                       
+                       # Number of seconds over which chain scores (and user scores) halve as they age,
+                       # applied whenever an edge is read or written (None for scores which never decay)
+                       "half_life": None,
+                       
+                       # Directory to keep each chain in a database file of its own, attached to the
+                       # main database (None to keep the chains in the main database). Chains kept in
+                       # the main database until then are moved into their files.
+                       "chain_directory": None,
+                       
+                       # Score transitions from an in-memory mirror of the chains instead of SQL
+                       "in_memory": False,
+                       
+                       # Number of source tracks to cache transition scores for
+                       "transition_cache_size": 128,
+                       
+                       # Number of source tracks to cache an alias table for, giving O(1) picks
+                       "sampler_cache_size": 128,
+                       
+                       # Number of candidate tracks to keep for each source track, picking among
+                       # them instead of scoring the whole catalog (0 to score every track)
+                       "candidate_count": 0,
+                       
+                       # Probability of picking a track uniformly from the catalog instead of from
+                       # the candidates, and the number of source tracks to keep candidates for
+                       "exploration": 0.05,
+                       "candidate_cache_size": 4096,
+                       
+                       # Seed of the random number generator used to pick tracks (None for a random seed)
+                       "random_seed": None,
+                       
+                       # PRAGMA profile name or settings for the database (see musicdb.PRAGMA_PROFILES)
+                       "pragmas": "default",
+                       
+                       # Number of reader connections to pool, making the conductor safe to share
+                       # between threads (0 for a single connection)
+                       "pool_size": 0,
+                       
+                       # Record the count and time of track picks, transitions and SQL statements
+                       # (see stats), logging them every stats_interval seconds if it is set
+                       "profile": False,
+                       "stats_interval": None,
+                       
+                       # Capture the query plan of SQL queries slower than this many seconds (with profile)
+                       "slow_query_time": None,
+                       
+                       # Queue transitions and feedback, writing them to the database in batches
+                       # from a background thread (implies in_memory, and a pool of readers)
+                       "write_behind": False,
+                       
+                       # Number of queued events, and seconds, after which the queue is written
+                       "write_behind_size": 256,
+                       "write_behind_interval": 1.0,
+                       
+                       # Path of a journal of queued events, replayed after a crash (None for none)
+                       "write_behind_journal": None,
+                       
+                       # Number of days of history to keep in full when maintaining the database;
+                       # older entries are rolled up into daily counts (None to keep every entry)
+                       "history_retention": None,
+                       
+                       # Directory to archive expired history entries to, as gzipped CSV files
+                       "history_archive": None,
+                       
+                       # Path of a model snapshot (see export_snapshot) to pick tracks from, making
+                       # the conductor read-only, and the number of seconds between checks for a
+                       # newer snapshot
+                       "snapshot": None,
+                       "snapshot_check_interval": 1.0}
         
         self.config.update(config)
+        if self.config["write_behind"]:
+            # Pending events are only visible to the in-memory model, and written from another thread
+            self.config["in_memory"] = True
+            self.config["pool_size"] = max(self.config["pool_size"], 1)
         
+        Conductor.__init__(self, dbpath, pragmas=self.config["pragmas"], pool_size=self.config["pool_size"],
+                           profile=self.config["profile"], slow_query_time=self.config["slow_query_time"],
+                           readonly=bool(self.config["snapshot"]))
+        self.decay = None
+        self.caches_expire = None
+        if self.config["half_life"]:
+            self.decay = decay_function(self.config["half_life"])
+            self.musicdb.create_function("decay", 2, self.decay)
+            
+            # Cached scores are dropped once they may have decayed by 1%
+            self.cache_lifetime = self.config["half_life"] * math.log(1 / 0.99, 2)
+            self.caches_expire = time.time() + self.cache_lifetime
+        self.metrics = Metrics(self.config["profile"])
+        self.stats_logger = None
+        self.chains = {}
+        self.model = None
+        
+        # Projection of the track fields chains transition between, shared by all chains
+        self.catalog = CatalogTable(self.musicdb)
+        self.rng = random.Random(self.config["random_seed"])
+        self.transitions = SourceCache(self.musicdb, self.config["transition_cache_size"])
+        self.samplers = SourceCache(self.musicdb, self.config["sampler_cache_size"])
+        self.candidates = None
+        self.writer = None
+        self.snapshot_checked = None
+    
     def load(self):
         _log.info("Loading MarkovConductor.")
         
-        self.musicdb.load()
+        if self.config["snapshot"]:
+            self.musicdb.load()
+            self._load_snapshot()
+            return
+        
+        if self.config["write_behind"]:
+            self.writer = WriteBehindQueue(self, self.config["write_behind_size"],
+                                           self.config["write_behind_interval"],
+                                           self.config["write_behind_journal"])
+        
+        self.musicdb.load(self._schema())
         self.init()
         
-        with self.musicdb.db:
+        self.catalog.load()
+        if self.config["in_memory"]:
+            self.model = MemoryModel(self.musicdb, self.catalog)
+            self.model.load()
+        
+        if self.config["candidate_count"]:
+            model = self.model
+            if not model:
+                # Candidates only need the field indexes; the edges are read from the chain tables
+                model = MemoryModel(self.musicdb, self.catalog)
+                model.load()
+            self.candidates = CandidateIndex(self, model, self.config["candidate_count"], self.config["exploration"],
+                                             self.config["candidate_cache_size"])
+        
+        with self.musicdb.transaction():
             chains = self.musicdb.execute("SELECT * FROM chain").fetchall()
         
         _log.info("Initializing chains.")
         for row in chains:
             # Note: we must convert the row values to ASCII strings (from unicode strings)
-            self.init_chain(str(row["fromfield"]), str(row["tofield"]))
+            self._load_chain(str(row["fromfield"]), str(row["tofield"]))
         
+        if self.writer:
+            for event in self.writer.start():
+                self._score_event(event)
+        
+        self.musicdb.store_fingerprint()
+        self._start_stats_logger()
+    
+    def _schema(self):
+        """Count the migrations of the conductor's components, to fingerprint the schema by."""
+        # Every chain shares the same migrations
+        schema = {"markov": len(self.migrations()),
+                  "chain": len(MarkovChain(self.musicdb, "trackid", "trackid", self.catalog).migrations())}
+        if self.writer:
+            schema["writebehind"] = len(self.writer.migrations())
+        return schema
+    
+    def _load_snapshot(self):
+        self.model = SnapshotModel(self.config["snapshot"])
+        self.model.load()
+        self.catalog = self.model.catalog
+        self.chains = self.model.chains
+        self.snapshot_checked = time.time()
+        
+        if self.config["candidate_count"]:
+            self.candidates = CandidateIndex(self, self.model, self.config["candidate_count"], self.config["exploration"],
+                                             self.config["candidate_cache_size"])
+        self._start_stats_logger()
+    
+    def _check_snapshot(self):
+        """Switch to a newer snapshot, if one has been published since the last check."""
+        now = time.time()
+        if now - self.snapshot_checked < self.config["snapshot_check_interval"]:
+            return
+        
+        self.snapshot_checked = now
+        if self.model.reload():
+            self.catalog = self.model.catalog
+            self.chains = self.model.chains
+            if self.candidates is not None:
+                self.candidates.model = self.model
+            self.clear_caches()
+    
+    def _expire_caches(self):
+        now = time.time()
+        if now >= self.caches_expire:
+            self.clear_caches()
+            self.caches_expire = now + self.cache_lifetime
+    
+    def _start_stats_logger(self):
+        if self.config["profile"] and self.config["stats_interval"]:
+            self.stats_logger = StatsLogger(self.stats, self.config["stats_interval"])
+            self.stats_logger.start()
+    
+    def export_snapshot(self, path):
+        """Publish a snapshot of the model for read-only conductors, returning its generation.
+        
+        The snapshot replaces any previous one at the same path atomically; read-only conductors
+        using it switch to the new snapshot on their next check.
+        
+        """
+        self.flush()
+        return write_snapshot(path, self.catalog, self.chains.values())
+    
+    def _check_writable(self):
+        if self.config["snapshot"]:
+            raise ValueError("This conductor is read-only, as it picks tracks from a snapshot.")
+    
     def unload(self):
+        if self.stats_logger:
+            self.stats_logger.stop()
+            self.stats_logger = None
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+        self.clear_caches()
+        self.model = None
+        self.candidates = None
         self.musicdb.unload()
+    
+    def seed(self, seed):
+        """Reseed the random number generator used to pick tracks, to replay a sequence of picks."""
+        self.rng.seed(seed)
+    
+    def flush(self):
+        """Write any queued transitions and feedback to the database (with write_behind)."""
+        if self.writer:
+            self.writer.flush()
+    
+    @contextmanager
+    def _flushed(self):
+        """Write any queued transitions and feedback, holding off queueing more until the block exits."""
+        if not self.writer:
+            yield
+            return
+        
+        with self.writer.held():
+            yield
+    
+    def maintain(self, pages=None, full_vacuum=False):
+        """Expire old history, then reclaim free space in the database and refresh its statistics.
+        
+        History older than history_retention days is expired (see MusicHistory.expire), before
+        the database itself is maintained (see MusicDB.maintain).
+        
+        """
+        self._check_writable()
+        self.flush()
+        if self.config["history_retention"] is not None:
+            before = datetime.datetime.now() - datetime.timedelta(days=self.config["history_retention"])
+            self.musicdb.history.expire(before, self.config["history_archive"])
+        self.musicdb.maintain(pages, full_vacuum)
+    
+    def rebuild_chain(self, fromfield, tofield, processes=None):
+        """Rebuild the scores of a chain by replaying the history, initializing the chain if needed.
+        
+        The conductor keeps picking tracks from the previous scores until the rebuilt ones are
+        loaded (see rebuild.rebuild_chains).
+        
+        """
+        self.init_chain(fromfield, tofield)
+        self._rebuild([self.chains[fromfield, tofield]], processes)
+    
+    def rebuild_all(self, processes=None):
+        """Rebuild the scores of every chain by replaying the history (see rebuild_chain)."""
+        self._rebuild(self.chains.values(), processes)
+    
+    def _rebuild(self, chains, processes):
+        self._check_writable()
+        self.flush()
+        rebuild_chains(self, chains, processes)
+        self.clear_caches()
+    
+    def clear_caches(self):
+        """Drop all cached transition data, e.g. after changing the configuration."""
+        self.transitions.clear()
+        self.samplers.clear()
+        if self.candidates is not None:
+            self.candidates.clear()
+    
+    def stats(self):
+        """Report the metrics of the conductor's operations and SQL statements, and of its caches.
         
+        Operations and statements are only measured with the profile option enabled.
+        
+        """
+        return {"operations": self.metrics.stats(),
+                "statements": self.musicdb.statement_stats(),
+                "caches": self.cache_stats()}
+    
+    def cache_stats(self):
+        """Report the size, hits, misses and evictions of the transition caches."""
+        stats = {"transitions": self.transitions.stats(),
+                 "samplers": self.samplers.stats()}
+        if self.candidates is not None:
+            stats["candidates"] = self.candidates.stats()
+        return stats
+    
     def init(self):
         _log.info("Initializing schema.")
-        
-        with self.musicdb.db:
+        self.musicdb.migrate("markov", self.migrations())
+    
+    def migrations(self):
+        return [self._init_schema]
+    
+    def _init_schema(self):
+        with self.musicdb.transaction():
             self.musicdb.execute("""
                 CREATE TABLE IF NOT EXISTS chain (
                     fromfield TEXT NOT NULL,
@@ -70,148 +371,480 @@ class MarkovConductor(Conductor):
     
     def init_chain(self, fromfield, tofield):
         _log.info("Initializing chain: %s -> %s.", fromfield, tofield)
+        self._check_writable()
+        for field in (fromfield, tofield):
+            if field not in CatalogTable.fields:
+                raise ValueError("Chains can only transition between the fields %s, not \"%s\"."
+                                 % (", ".join(CatalogTable.fields), field))
+        
         if not (fromfield, tofield) in self.chains:
-            self.musicdb.execute("""
-                INSERT OR IGNORE
-                    INTO chain (fromfield, tofield)
-                    VALUES (:fromfield, :tofield)
-                """, {"fromfield": fromfield, "tofield": tofield})
+            self.flush()
+            with self.musicdb.transaction():
+                self.musicdb.execute("""
+                    INSERT OR IGNORE
+                        INTO chain (fromfield, tofield)
+                        VALUES (:fromfield, :tofield)
+                    """, {"fromfield": fromfield, "tofield": tofield})
             
-            chain = MarkovChain(self.musicdb, fromfield, tofield)
-            chain.init()
-            self.chains[fromfield, tofield] = chain
+            self._load_chain(fromfield, tofield)
+            self.clear_caches()
+    
+    def _load_chain(self, fromfield, tofield):
+        shard = None
+        if self.config["chain_directory"]:
+            shard = os.path.join(self.config["chain_directory"], "chain_%s_%s.db" % (fromfield, tofield))
+        chain = MarkovChain(self.musicdb, fromfield, tofield, self.catalog, self.decay, shard)
+        chain.init()
+        if self.model:
+            chain.load_edges()
+        self.chains[fromfield, tofield] = chain
     
     def delete_chain(self, fromfield, tofield):
+        self._check_writable()
         if (fromfield, tofield) in self.chains:
-            self.musicdb.execute("""
-                DELETE FROM chain
-                WHERE fromfield=:fromfield AND tofield=:tofield
-                """, {"fromfield": fromfield, "tofield": tofield})
+            self.flush()
+            with self.musicdb.transaction():
+                self.musicdb.execute("""
+                    DELETE FROM chain
+                    WHERE fromfield=:fromfield AND tofield=:tofield
+                    """, {"fromfield": fromfield, "tofield": tofield})
             
             self.chains[fromfield, tofield].delete()
             del self.chains[fromfield, tofield]
+            self.clear_caches()
     
-    def record_transition(self, fromtrack, totrack, userchoice=True):
-        fromtrack, totrack = self._lookup_tracks(fromtrack, totrack)
+    @timed("record_transition")
+    def _record_transition(self, fromtrack, totrack, userchoice):
         _log.info("Recording transition from track %s to %s.", fromtrack.id if fromtrack else "[No track]", totrack.id)
+        self._check_writable()
+        
+        if self.writer:
+            # Events are queued and applied to the in-memory model together (see WriteBehindQueue.held)
+            with self.writer.condition:
+                event = self.writer.record_transition(fromtrack, totrack, userchoice)
+                self.score_transition(fromtrack, totrack, self._transition_amount(userchoice), pending=True)
+            return event
+        
+        with self.musicdb.transaction():
+            historyid = Conductor._record_transition(self, fromtrack, totrack, userchoice)
+            self.score_transition(fromtrack, totrack, self._transition_amount(userchoice))
+        return historyid
+    
+    def record_transitions(self, transitions):
+        self._check_writable()
+        
+        # Queued events come first in the history
+        self.flush()
+        Conductor.record_transitions(self, transitions)
+    
+    def _record_transitions(self, transitions):
+        historyid = Conductor._record_transitions(self, transitions)
         
-        Conductor.record_transition(self, fromtrack, totrack, userchoice)
+        # Decaying scores are decayed from the time of each transition, as when they are rebuilt
+        amounts = [self._transition_amount(userchoice) for timestamp, fromtrack, totrack, userchoice in transitions]
+        if self.decay:
+            now = time.time()
+            amounts = [amount * self.decay(epoch_seconds(transition[0]), now)
+                       for amount, transition in izip(amounts, transitions)]
         
+        for chain in self.chains.values():
+            deltas = {}
+            for (timestamp, fromtrack, totrack, userchoice), amount in izip(transitions, amounts):
+                key = (fromtrack[chain.fromfield] if fromtrack else -1, totrack[chain.tofield])
+                deltas[key] = deltas.get(key, 0) + amount
+            chain.record_transitions(dict((key, (amount, 0)) for key, amount in deltas.iteritems()))
+        
+        # A bulk import touches too many sources for targeted invalidation to pay off
+        self.clear_caches()
+        return historyid
+    
+    def _transition_amount(self, userchoice):
         if userchoice:
-            amount = self.config["user_choice_score"]
+            return self.config["user_choice_score"]
         else:
-            amount = self.config["markov_choice_score"]
-        self.score_transition(fromtrack, totrack, amount)
+            return self.config["markov_choice_score"]
     
-    def record_user_feedback(self, liked):
-        """Called when a user likes or dislikes a transition."""
-        Conductor.record_user_feedback(self, liked)
-        self.score_transition(user_amount=(1 if liked else -1), *self.last_transition)
+    @timed("record_user_feedback")
+    def _record_user_feedback(self, transition, historyid, liked):
+        self._check_writable()
+        if self.writer:
+            with self.writer.condition:
+                self.writer.record_user_feedback(transition, historyid, liked)
+                self.score_transition(user_amount=(1 if liked else -1), pending=True, *transition)
+            return
+        
+        with self.musicdb.transaction():
+            Conductor._record_user_feedback(self, transition, historyid, liked)
+            self.score_transition(user_amount=(1 if liked else -1), *transition)
     
-    def score_transition(self, fromtrack, totrack, amount=0, user_amount=0):
-        """Change the inferred score/user score for a transition by a delta."""
-        for chain in self.chains.values():
-            chain.record_transition(fromtrack.id if fromtrack else None, totrack.id, amount, user_amount)
+    def _score_event(self, event):
+        """Apply a queued event to the in-memory model."""
+        if isinstance(event, TransitionEvent):
+            self.score_transition(event.fromtrack, event.totrack, self._transition_amount(event.userchoice), pending=True)
+        else:
+            self.score_transition(user_amount=(1 if event.liked else -1), pending=True, *event.transition)
+    
+    def _write_events(self, events):
+        """Write queued events to the database. This must be called within a transaction."""
+        transitions = [event for event in events if isinstance(event, TransitionEvent)]
+        if transitions:
+            historyid = Conductor._record_transitions(self, [(event.timestamp, event.fromtrack, event.totrack, event.userchoice)
+                                                             for event in transitions])
+            
+            # The history entries were inserted in order, each taking the next rowid
+            for event in reversed(transitions):
+                event.historyid = historyid
+                historyid -= 1
+        
+        deltas = dict((chain, {}) for chain in self.chains.values())
+        for event in events:
+            if isinstance(event, TransitionEvent):
+                fromtrack, totrack = event.fromtrack, event.totrack
+                amount, user_amount = self._transition_amount(event.userchoice), 0
+            else:
+                fromtrack, totrack = event.transition
+                amount, user_amount = 0, (1 if event.liked else -1)
+                if event.historyid is not None:
+                    Conductor._record_user_feedback(self, event.transition, event.historyid, event.liked)
+            
+            for chain, chain_deltas in deltas.iteritems():
+                key = (fromtrack[chain.fromfield] if fromtrack else -1, totrack[chain.tofield])
+                total = chain_deltas.get(key, (0, 0))
+                chain_deltas[key] = (total[0] + amount, total[1] + user_amount)
+        
+        for chain, chain_deltas in deltas.iteritems():
+            chain.store_transitions(chain_deltas)
+    
+    def score_transition(self, fromtrack, totrack, amount=0, user_amount=0, pending=False):
+        """Change the inferred score/user score for a transition by a delta.
+        
+        Pending transitions are only applied to the in-memory model, leaving the database to be
+        updated by the write-behind queue.
+        
+        """
+        def score():
+            for chain in self.chains.values():
+                fromvalue = chain.record_transition(fromtrack.id if fromtrack else None, totrack.id,
+                                                    amount, user_amount, pending)
+                fromvalues.append((chain.fromfield, fromvalue))
+        
+        fromvalues = []
+        if pending:
+            score()
+        else:
+            with self.musicdb.transaction():
+                score()
         
+        for fromfield, fromvalue in fromvalues:
+            if fromvalue is not None:
+                self.transitions.invalidate(fromfield, fromvalue)
+                self.samplers.invalidate(fromfield, fromvalue)
+                if self.candidates is not None:
+                    self.candidates.invalidate(fromfield, fromvalue)
+    
     def choose_next_track(self, fromtrack=None):
         """Determine the next track to play via Markov Chain calculation.
         
         Returns a dictionary containing the name, album, artist, and genre of the chosen track.
         
+        """
+        return self.choose_next_tracks(fromtrack)[0]
+    
+    @timed("choose_next_track")
+    def choose_next_tracks(self, fromtrack=None, count=1):
+        """Pick several tracks to follow the same track at once, e.g. for many listeners.
+        
+        The transitions from the track are scored only once. Returns a list of track dictionaries.
+        
         """
         fromtrack = self._lookup_tracks(fromtrack)[0]        
         fromid = fromtrack.id if fromtrack else None
-        toid = self.choose_next_id(fromid)
         
-        totrack = self.musicdb.get_track_by_id(toid)
-        return self.get_desc(totrack)
+        return [self.get_desc(self.musicdb.get_track_by_id(toid))
+                for toid in self.choose_next_ids(fromid, count)]
     
     def choose_next_id(self, fromid=None):
-        return weighted_choice(self.get_transitions_from_id(fromid))
+        return self.choose_next_ids(fromid)[0]
+    
+    def choose_next_ids(self, fromid=None, count=1):
+        if self.snapshot_checked is not None:
+            self._check_snapshot()
+        if self.caches_expire is not None:
+            self._expire_caches()
+        
+        if self.candidates is not None:
+            return [self.candidates.sample(fromid, self.rng) for i in xrange(count)]
+        
+        if not self.config["sampler_cache_size"]:
+            scores = self.get_transitions_from_id(fromid)
+            return [weighted_choice(scores, self.rng) for i in xrange(count)]
+        
+        table = self._get_sampler(fromid)
+        return [table.sample(self.rng) for i in xrange(count)]
+    
+    def _get_sampler(self, fromid):
+        table = self.samplers.get(fromid)
+        if table is None:
+            generation = self.samplers.generation
+            table = AliasTable(self.get_transitions_from_id(fromid))
+            self.samplers.put(fromid, self._get_source_fields(fromid), table, generation)
+        return table
+    
+    @timed("generate_playlist")
+    def generate_playlist(self, start=None, length=10, no_repeat=0, beam_width=0, ids=False):
+        """Generate a whole playlist of tracks to follow the start track.
+        
+        Tracks are sampled one after another, as by choose_next_track. A track is not picked again
+        within no_repeat tracks of its previous pick (or of the start track), unless nothing else
+        can follow. With a beam_width, the most likely playlist found by a beam search of that
+        width is returned instead of a random one.
+        
+        Returns a list of track dictionaries, or of track ids if ids is true.
+        
+        """
+        start = self._lookup_tracks(start)[0]
+        startid = start.id if start else None
+        
+        if beam_width:
+            playlist = self._beam_search(startid, length, no_repeat, beam_width)
+        else:
+            playlist = self._sample_playlist(startid, length, no_repeat)
+        
+        if ids:
+            return playlist
+        return [self.get_desc(self.musicdb.get_track_by_id(toid)) for toid in playlist]
+    
+    def _recent(self, startid, playlist, no_repeat):
+        """Get the tracks which may not be picked next, as the last no_repeat tracks played."""
+        if not no_repeat:
+            return ()
+        played = ([startid] if startid else []) + playlist[-no_repeat:]
+        return set(played[-no_repeat:])
+    
+    def _sample_playlist(self, startid, length, no_repeat):
+        playlist = []
+        fromid = startid
+        for i in xrange(length):
+            if self.candidates is None and not self.get_transitions_from_id(fromid):
+                break
+            
+            recent = self._recent(startid, playlist, no_repeat)
+            toid = self.choose_next_id(fromid)
+            if toid in recent:
+                # Fall back to picking among the remaining tracks, when rejecting a few picks isn't enough
+                for attempt in xrange(8):
+                    toid = self.choose_next_id(fromid)
+                    if toid not in recent:
+                        break
+                else:
+                    allowed = dict((trackid, weight) for trackid, weight in self.get_transitions_from_id(fromid).iteritems()
+                                   if trackid not in recent)
+                    if allowed:
+                        toid = weighted_choice(allowed, self.rng)
+            
+            playlist.append(toid)
+            fromid = toid
+        return playlist
+    
+    def _beam_search(self, startid, length, no_repeat, beam_width):
+        # Each beam is a (log probability, playlist) pair
+        beams = [(0.0, [])]
+        candidates = {}
+        for i in xrange(length):
+            expanded = []
+            for logprob, playlist in beams:
+                fromid = playlist[-1] if playlist else startid
+                if fromid not in candidates:
+                    # The likeliest tracks to follow, by log probability (enough to survive the repeat window)
+                    scores = self.get_transitions_from_id(fromid)
+                    total = float(sum(scores.itervalues()))
+                    best = heapq.nlargest(beam_width + no_repeat, scores.iteritems(), key=lambda item: item[1])
+                    candidates[fromid] = [(math.log(weight / total), toid) for toid, weight in best if weight > 0]
+                
+                recent = self._recent(startid, playlist, no_repeat)
+                allowed = [(step, toid) for step, toid in candidates[fromid] if toid not in recent]
+                for step, toid in (allowed or candidates[fromid])[:beam_width]:
+                    expanded.append((logprob + step, playlist + [toid]))
+            
+            if not expanded:
+                break
+            beams = heapq.nlargest(beam_width, expanded, key=lambda beam: beam[0])
+        return beams[0][1]
+    
+    def _get_source_fields(self, fromid):
+        """Get the field values of a source track which the chains transition from."""
+        if not fromid:
+            return None
+        return self.catalog.get_fields(fromid)
     
     def _calculate_weight(self, conductor, score, user_score):
-        """Calculate a weighting based on an inferred score and user-specified score"""
-        return math.exp(user_score) * math.exp(score*4)
+        """Calculate a weighting based on an inferred score and user-specified score.
+        
+        The default weighting, calculate_weight, is vectorized; overriding this method in a subclass
+        makes it the default weight function instead.
+        """
+        return calculate_weight_scalar(conductor, score, user_score)
     
     def get_transitions_from_id(self, fromid=None):
         """Determine the ids and scores of possible following tracks based on the current track id.
         
+        Results are cached per source track, and must not be modified.
+        
         Returns: a dictionary of the form { trackid: score, .. }
         
+        """
+        if self.snapshot_checked is not None:
+            self._check_snapshot()
+        if self.caches_expire is not None:
+            self._expire_caches()
+        
+        scores = self.transitions.get(fromid)
+        if scores is not None:
+            return scores
+        
+        _log.info("Calculating transitions from track id %s...", fromid)
+        generation = self.transitions.generation
+        with self.metrics.timer("score_transitions"):
+            if self.model:
+                rows = self.model.get_scores(fromid, self.chains.values(), self.config)
+            else:
+                rows = self._query_scores(fromid)
+        
+        scores = {}
+        if rows:
+            totrackids, totalscores, totaluserscores = zip(*rows)
+            weights = batch_weight_function(self.config["weight_function"])(self, totalscores, totaluserscores)
+            if hasattr(weights, "tolist"):
+                weights = weights.tolist()
+            scores = dict(izip(totrackids, weights))
+        
+        _log.debug("Calculated scores for track id %s: %r.", fromid, scores)
+        if scores:
+            self.transitions.put(fromid, self._get_source_fields(fromid), scores, generation)
+        return scores
+    
+    def _query_scores(self, fromid):
+        """Sum the chain scores of every track following the given track id in SQL.
+        
+        Returns: a list of rows of the form (totrackid, totalscore, totaluserscore)
+        
         """
         def if_fromid(truestr, falsestr=""):
             return truestr if fromid else falsestr
         
-        _log.info("Calculating transitions from track id %s...", fromid)
-        with self.musicdb.db:
-            sql = " ".join((
-                "SELECT totrack.trackid AS totrackid,",
-                        
-                        # Sum chain scores for each destination track (0 if null)
-                        # Scores are normalized by dividing by the total of all scores. Thus, the maximum possible value is 1.
-                        #
-                        # e.g. ifnull(transition_field_field.score, 0) / (SELECT SUM(score) FROM table WHERE from_field=fromtrack.field)
-                        #
-                        " + ".join(("CAST(ifnull(%(table)s.score, %(default_score)s) AS FLOAT)" +
-                                    "/ ifnull(" +
-                                        "(SELECT MAX(%(min_score_divisor)s, MAX(score)) FROM %(table)s" +
-                                        " WHERE %(fromfield_column)s=" + if_fromid("fromtrack.%(fromfield)s", "-1") +
-                                    "), 1)")
-                                   % {"table": c.table,
-                                      "fromfield": c.fromfield,
-                                      "fromfield_column": c.fromfield_column,
-                                      "min_score_divisor": self.config["min_score_divisor"],
-                                      "default_score": self.config["default_score"]}
-                                   for c in self.chains.values()),
-                        "AS totalscore,",
-                        
-                        " + ".join(("ifnull(" + 
-                                        "MAX(%(min_userscore)s, MIN(%(max_userscore)s, %(table)s.userscore))" +
-                                    ", %(default_userscore)s)")
-                                   % {"table": c.table,
-                                      "min_userscore": self.config["min_userscore"],
-                                      "max_userscore": self.config["max_userscore"],
-                                      "default_userscore": self.config["default_userscore"]}
-                                   for c in self.chains.values()),
-                        "AS totaluserscore",
-                                    
-                    "FROM " + if_fromid("track fromtrack, ") + "track totrack",
+        chains = list(enumerate(self.chains.values()))
+        
+        source_sql = " ".join((
+            "SELECT",
                     
-                        # Left join with each chain's matching edges
-                        # (such that chain.from_field=fromtrack.fromfield and chain.to_field=totrack.tofield)
-                        #
-                        # e.g. LEFT JOIN transition_field_field ON (from_field=fromtrack.field AND to_field=totrack.field)
-                        #
-                        " ".join(("LEFT JOIN %(table)s ON (%(table)s.%(tofield_column)s=totrack.%(tofield)s" +
-                                  " AND %(table)s.%(fromfield_column)s=" + if_fromid("fromtrack.%(fromfield)s", "-1") + ")")
-                                 % {"table": c.table,
-                                    "fromfield": c.fromfield,
-                                    "fromfield_column": c.fromfield_column,
-                                    "tofield_column": c.tofield_column,
-                                    "tofield": c.tofield}
-                                 for c in self.chains.values()),
-                                    
-                    if_fromid("WHERE fromtrack.trackid=%s" % fromid),
-                ))
+                    # Select the from field of the current track for each chain, along with the largest
+                    # score leaving it, which the chain's scores are normalized by (1 if it has no edges)
+                    #
+                    # e.g. fromtrack.field AS from_0, ifnull(MAX(10, transition_field_field_max.maxscore), 1) AS divisor_0
+                    #
+                    ", ".join(("%(fromvalue)s AS from_%(index)s, " +
+                               "ifnull(MAX(%(min_score_divisor)s, %(maxscore)s), 1) AS divisor_%(index)s")
+                              % {"index": index,
+                                 "maxscore": c.decayed("maxscore", c.max_table),
+                                 "fromvalue": if_fromid("fromtrack.%s" % c.fromfield, "-1"),
+                                 "min_score_divisor": self.config["min_score_divisor"]}
+                              for index, c in chains),
             
-            scores = {}
-            for row in self.musicdb.execute(sql):
-                scores[row["totrackid"]] = self.config["weight_function"](self, row["totalscore"], row["totaluserscore"])
+            "FROM " + if_fromid("track fromtrack", "(SELECT 1)"),
+                    
+                    # e.g. LEFT JOIN transition_field_field_max ON (transition_field_field_max.from_field=fromtrack.field)
+                    " ".join(("LEFT JOIN %(max_table)s ON (%(max_table)s.%(fromfield_column)s=%(fromvalue)s)")
+                             % {"max_table": c.max_table,
+                                "fromfield_column": c.fromfield_column,
+                                "fromvalue": if_fromid("fromtrack.%s" % c.fromfield, "-1")}
+                             for index, c in chains),
             
-            _log.debug("Calculated scores for track id %s: %s.", fromid, repr(scores))
-            return scores
-    
+            if_fromid("WHERE fromtrack.trackid=:fromid"),
+        ))
+        
+        sql = " ".join((
+            "SELECT totrack.trackid AS totrackid,",
+                    
+                    # Sum chain scores for each destination track (0 if null)
+                    # Scores are normalized by dividing by the maximum of all scores. Thus, the maximum possible value is 1.
+                    #
+                    # e.g. ifnull(transition_field_field.score, 0) / source.divisor_0
+                    #
+                    " + ".join(("CAST(ifnull(%(score)s, %(default_score)s) AS FLOAT) / source.divisor_%(index)s")
+                               % {"index": index,
+                                  "score": c.decayed("score", c.table),
+                                  "default_score": self.config["default_score"]}
+                               for index, c in chains),
+                    "AS totalscore,",
+                    
+                    " + ".join(("ifnull(" + 
+                                    "MAX(%(min_userscore)s, MIN(%(max_userscore)s, %(userscore)s))" +
+                                ", %(default_userscore)s)")
+                               % {"userscore": c.decayed("userscore", c.table),
+                                  "min_userscore": self.config["min_userscore"],
+                                  "max_userscore": self.config["max_userscore"],
+                                  "default_userscore": self.config["default_userscore"]}
+                               for index, c in chains),
+                    "AS totaluserscore",
+                
+                # The single source row is evaluated once, ahead of the scan over destination tracks
+                "FROM (" + source_sql + ") AS source CROSS JOIN track totrack",
+                    
+                    # Left join with each chain's matching edges
+                    # (such that chain.from_field=fromtrack.fromfield and chain.to_field=totrack.tofield)
+                    #
+                    # e.g. LEFT JOIN transition_field_field ON (to_field=totrack.field AND from_field=source.from_0)
+                    #
+                    " ".join(("LEFT JOIN %(table)s ON (%(table)s.%(tofield_column)s=totrack.%(tofield)s" +
+                              " AND %(table)s.%(fromfield_column)s=source.from_%(index)s)")
+                             % {"index": index,
+                                "table": c.table,
+                                "fromfield_column": c.fromfield_column,
+                                "tofield_column": c.tofield_column,
+                                "tofield": c.tofield}
+                             for index, c in chains),
+            ))
+        
+        return self.musicdb.query(sql, {"now": time.time(), "fromid": fromid})
+
 class MarkovChain:
-    
-    def __init__(self, musicdb, fromfield, tofield):
+
+    def __init__(self, musicdb, fromfield, tofield, catalog=None, decay=None, shard=None):
         self.musicdb = musicdb
         self.fromfield = fromfield
         self.tofield = tofield
+        self.catalog = catalog if catalog is not None else CatalogTable(musicdb)
+        
+        # Path of a database file of the chain's own, attached as a schema named after the chain
+        # (None to keep the chain in the main database)
+        self.shard = shard
+        
+        # Decay function of the scores (see decay_function), also defined as the SQL function decay()
+        self.decay = decay
+        
+        # In-memory mirror of the chain table, of the form { fromvalue: { tovalue: [score, userscore, updated] } },
+        # along with the maximum score leaving each from value, of the form { fromvalue: [maxscore, updated] }
+        self.edges = None
+        self.maxima = None
     
     @property
-    def table(self):
+    def name(self):
         return "chain_"+self.fromfield+"_"+self.tofield
     
+    @property
+    def schema(self):
+        return self.name if self.shard else "main"
+    
+    @property
+    def table(self):
+        if self.shard:
+            return self.schema+"."+self.name
+        return self.name
+    
+    @property
+    def max_table(self):
+        return self.table+"_max"
+    
     @property
     def fromfield_column(self):
         return "from_"+self.fromfield
@@ -222,7 +855,47 @@ class MarkovChain:
     
     def init(self):
         _log.debug("Initializing chain schema: %s -> %s.", self.fromfield, self.tofield)
-        with self.musicdb.db:                     
+        if self.shard:
+            self.musicdb.attach(self.schema, self.shard)
+        self.musicdb.migrate(self.name, self.migrations(), self.schema)
+        if self.shard and self.musicdb.get_schema_version(self.name):
+            self._move_to_shard()
+    
+    def _move_to_shard(self):
+        """Move the chain's tables from the main database, where it was kept until now, into its file."""
+        _log.info("Moving chain %s -> %s into %s.", self.fromfield, self.tofield, self.shard)
+        
+        # Bring the tables in the main database up to date first, so that every column comes along
+        main = MarkovChain(self.musicdb, self.fromfield, self.tofield, self.catalog, self.decay)
+        main.init()
+        columns = {"table": self.table,
+                   "max_table": self.max_table,
+                   "main_table": main.table,
+                   "main_max_table": main.max_table,
+                   "fromfield_column": self.fromfield_column,
+                   "tofield_column": self.tofield_column}
+        
+        with self.musicdb.transaction():
+            self.musicdb.execute("""
+                INSERT OR REPLACE
+                    INTO %(table)s (%(fromfield_column)s, %(tofield_column)s, score, userscore, updated)
+                    SELECT %(fromfield_column)s, %(tofield_column)s, score, userscore, updated FROM main.%(main_table)s
+                """ % columns)
+            self.musicdb.execute("""
+                INSERT OR REPLACE
+                    INTO %(max_table)s (%(fromfield_column)s, maxscore, updated)
+                    SELECT %(fromfield_column)s, maxscore, updated FROM main.%(main_max_table)s
+                """ % columns)
+            main.delete()
+    
+    def migrations(self):
+        return [self._init_schema,
+                self._init_indexes,
+                self._init_maxima,
+                self._init_updated]
+    
+    def _init_schema(self):
+        with self.musicdb.transaction():
             self.musicdb.execute("""
                 CREATE TABLE IF NOT EXISTS %(table)s (
                     %(fromfield_column)s INTEGER REFERENCES track(%(fromfield)s),
@@ -235,44 +908,267 @@ class MarkovChain:
                         "fromfield_column": self.fromfield_column,
                         "tofield": self.tofield,
                         "tofield_column": self.tofield_column})
+    
+    def _init_indexes(self):
+        # The primary key covers lookups by source; this covers lookups by destination
+        with self.musicdb.transaction():
+            self.musicdb.execute("CREATE INDEX IF NOT EXISTS %(schema)s.%(name)s_to ON %(name)s (%(tofield_column)s)"
+                                 % {"schema": self.schema, "name": self.name, "tofield_column": self.tofield_column})
+    
+    def _init_maxima(self):
+        # Materialize the maximum score leaving each from value, which scores are normalized by
+        with self.musicdb.transaction():
+            self.musicdb.execute("""
+                CREATE TABLE IF NOT EXISTS %(max_table)s (
+                    %(fromfield_column)s INTEGER PRIMARY KEY,
+                    maxscore INTEGER NOT NULL
+                )""" % {"max_table": self.max_table, "fromfield_column": self.fromfield_column})
             
+            self.musicdb.execute("""
+                INSERT OR REPLACE
+                    INTO %(max_table)s (%(fromfield_column)s, maxscore)
+                    SELECT %(fromfield_column)s, MAX(score) FROM %(table)s
+                        WHERE %(fromfield_column)s IS NOT NULL
+                        GROUP BY %(fromfield_column)s
+                """ % {"table": self.table, "max_table": self.max_table, "fromfield_column": self.fromfield_column})
+    
+    def _init_updated(self):
+        # Record when each edge was last updated, for scores to decay from. Existing edges count as
+        # updated now, which the column's default provides without rewriting the tables.
+        now = time.time()
+        with self.musicdb.transaction():
+            for table in (self.table, self.max_table):
+                self.musicdb.execute("ALTER TABLE %(table)s ADD COLUMN updated REAL DEFAULT %(now)r"
+                                     % {"table": table, "now": now})
+    
+    def decayed(self, column, table=None):
+        """Get the SQL expression of a score column as of the :now parameter, decayed since it was updated."""
+        prefix = table + "." if table else ""
+        if not self.decay:
+            return prefix + column
+        return "%(prefix)s%(column)s * decay(%(prefix)supdated, :now)" % {"prefix": prefix, "column": column}
+    
+    def _factor(self, updated, now):
+        """Get the factor by which a score updated at a time has decayed by now (1 without decay)."""
+        if not self.decay:
+            return 1
+        return self.decay(updated, now)
+    
+    def load_edges(self):
+        """Load the chain table into memory, keeping it in sync as transitions are recorded."""
+        _log.debug("Loading chain edges: %s -> %s.", self.fromfield, self.tofield)
+        
+        edges = {}
+        for fromid, toid, score, userscore, updated in self.musicdb.execute("""
+                SELECT %(fromfield_column)s, %(tofield_column)s, score, userscore, updated FROM %(table)s
+                """ % {"table": self.table, "fromfield_column": self.fromfield_column, "tofield_column": self.tofield_column}):
+            # Edges with a null field can never be matched by the scoring query
+            if fromid is not None and toid is not None:
+                edges.setdefault(fromid, {})[toid] = [score, userscore, updated]
+        
+        now = time.time()
+        self.edges = edges
+        self.maxima = dict((fromid, [max(edge[0] * self._factor(edge[2], now) for edge in toedges.itervalues()), now])
+                           for fromid, toedges in edges.iteritems())
+    
+    def get_edges(self, fromvalue):
+        """Get the edges leaving a from value, of the form { tovalue: [score, userscore, ..] }.
+        
+        The edges come from the in-memory mirror when it is loaded, and from the chain table otherwise.
+        Decaying scores are given as of now.
+        
+        """
+        if self.edges is not None:
+            edges = self.edges.get(fromvalue)
+            if not self.decay or not edges:
+                return edges
+            
+            # Other threads may add edges meanwhile, so the items are copied first
+            now = time.time()
+            decayed = {}
+            for toid, (score, userscore, updated) in edges.items():
+                factor = self.decay(updated, now)
+                decayed[toid] = [score * factor, userscore * factor]
+            return decayed
+        
+        return dict((toid, [score, userscore]) for toid, score, userscore in self.musicdb.query("""
+            SELECT %(tofield_column)s, %(score)s, %(userscore)s FROM %(table)s
+                WHERE %(fromfield_column)s=:fromvalue AND %(tofield_column)s IS NOT NULL
+            """ % {"table": self.table,
+                   "fromfield_column": self.fromfield_column,
+                   "tofield_column": self.tofield_column,
+                   "score": self.decayed("score"),
+                   "userscore": self.decayed("userscore")},
+            {"fromvalue": fromvalue, "now": time.time()}))
+    
+    def get_maximum(self, fromvalue):
+        """Get the largest score leaving a from value (None if it has no edges)."""
+        if self.maxima is not None:
+            maximum = self.maxima.get(fromvalue)
+            if maximum is not None:
+                return maximum[0] * self._factor(maximum[1], time.time())
+            return None
+        
+        rows = self.musicdb.query("SELECT %(maxscore)s FROM %(max_table)s WHERE %(fromfield_column)s=:fromvalue"
+                                  % {"max_table": self.max_table,
+                                     "fromfield_column": self.fromfield_column,
+                                     "maxscore": self.decayed("maxscore")},
+                                  {"fromvalue": fromvalue, "now": time.time()})
+        if rows:
+            return rows[0][0]
+    
     def delete(self):
         _log.debug("Deleting chain schema: %s -> %s.", self.fromfield, self.tofield)
-        with self.musicdb.db:
-            self.musicdb.execute("DROP TABLE %(table)s" % {"table": self.table})
+        if self.shard:
+            # The chain goes along with its file
+            self.musicdb.detach(self.schema)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.shard + suffix):
+                    os.remove(self.shard + suffix)
+            self.edges = None
+            self.maxima = None
+            return
         
+        with self.musicdb.transaction():
+            self.musicdb.execute("DROP TABLE %(table)s" % {"table": self.table})
+            self.musicdb.execute("DROP TABLE IF EXISTS %(max_table)s" % {"max_table": self.max_table})
+            self.musicdb.set_schema_version(self.name, 0)
+        self.edges = None
+        self.maxima = None
+    
     def reset(self):
         _log.debug("Clearing chain data: %s -> %s.", self.fromfield, self.tofield)
-        with self.musicdb.db:
+        with self.musicdb.transaction():
             self.musicdb.execute("DELETE FROM %(table)s" % {"table": self.table})
+            self.musicdb.execute("DELETE FROM %(max_table)s" % {"max_table": self.max_table})
+        if self.edges is not None:
+            self.edges.clear()
+            self.maxima.clear()
     
-    def record_transition(self, fromtrackid, totrackid, amount=0, user_amount=0):
-        def get_field(trackid, field):
-            return self.musicdb.get_track_by_id(trackid)[field];
-       
+    def replace_edges(self, edges, updated):
+        """Replace every edge of the chain, from a dictionary of the form { (fromvalue, tovalue): [score, userscore] }.
+        
+        The scores are taken as of the time updated.
+        
+        """
+        _log.debug("Replacing chain edges: %s -> %s.", self.fromfield, self.tofield)
+        columns = {"table": self.table,
+                   "max_table": self.max_table,
+                   "fromfield_column": self.fromfield_column,
+                   "tofield_column": self.tofield_column}
+        
+        with self.musicdb.transaction():
+            self.musicdb.execute("DELETE FROM %(table)s" % columns)
+            self.musicdb.executemany("""
+                INSERT
+                    INTO %(table)s (%(fromfield_column)s, %(tofield_column)s, score, userscore, updated)
+                    VALUES (?, ?, ?, ?, ?)
+                """ % columns, ((fromid, toid, score, userscore, updated)
+                                for (fromid, toid), (score, userscore) in sorted(edges.iteritems())))
+            
+            self.musicdb.execute("DELETE FROM %(max_table)s" % columns)
+            self.musicdb.execute("""
+                INSERT
+                    INTO %(max_table)s (%(fromfield_column)s, maxscore, updated)
+                    SELECT %(fromfield_column)s, MAX(score), :updated FROM %(table)s
+                        WHERE %(fromfield_column)s IS NOT NULL
+                        GROUP BY %(fromfield_column)s
+                """ % columns, {"updated": updated})
+            
+            if self.edges is not None:
+                self.load_edges()
+    
+    def record_transition(self, fromtrackid, totrackid, amount=0, user_amount=0, pending=False):
+        """Change the score/user score of a transition by a delta.
+        
+        Returns: the value of the from field the updated edge leaves (-1 for the start of a session)
+        
+        """
         _log.debug("Recording transition (%s -> %s) from track %s to %s.", self.fromfield, self.tofield, fromtrackid, totrackid)
-       
-        with self.musicdb.db:
-            if fromtrackid:
-                fromid = get_field(fromtrackid, self.fromfield)
-            else:
-                fromid = -1
+        
+        if fromtrackid:
+            fromid = self.catalog.get(fromtrackid, self.fromfield)
+        else:
+            fromid = -1
+        toid = self.catalog.get(totrackid, self.tofield)
+        
+        self.record_transitions({(fromid, toid): (amount, user_amount)}, pending)
+        return fromid
+    
+    def record_transitions(self, deltas, pending=False):
+        """Change the scores/user scores of many transitions at once.
+        
+        Accepts a dictionary of the form { (fromvalue, tovalue): (amount, user_amount) }. Edges with
+        a null field are skipped, since they can never be matched. Pending deltas are only applied
+        to the in-memory mirror, and must be written later with store_transitions.
+        
+        """
+        deltas = self._filter_deltas(deltas)
+        if not pending:
+            self._store_transitions(deltas)
+        
+        if self.edges is not None:
+            now = time.time()
+            for fromid, toid, amount, user_amount in deltas:
+                toedges = self.edges.setdefault(fromid, {})
+                edge = toedges.setdefault(toid, [0, 0, now])
+                factor = self._factor(edge[2], now)
+                edge[0] = edge[0] * factor + amount
+                edge[1] = edge[1] * factor + user_amount
+                edge[2] = now
                 
-            toid = get_field(totrackid, self.tofield)
-
-            # "Touch" the transition entry to ensure that it exists
-            self.musicdb.execute("""
-                INSERT OR IGNORE
-                    INTO %(table)s (%(fromfield_column)s, %(tofield_column)s)
-                    VALUES (:fromid, :toid)
-                """ % {"table": self.table, "fromfield_column": self.fromfield_column, "tofield_column": self.tofield_column},
-                {"fromid": fromid, "toid": toid})
+                maximum = self.maxima.get(fromid)
+                if amount >= 0 and maximum is not None:
+                    self.maxima[fromid] = [max(maximum[0] * self._factor(maximum[1], now), edge[0]), now]
+                else:
+                    self.maxima[fromid] = [max(edge[0] * self._factor(edge[2], now) for edge in toedges.itervalues()), now]
+    
+    def store_transitions(self, deltas):
+        """Write score deltas to the chain table, without applying them to the in-memory mirror."""
+        self._store_transitions(self._filter_deltas(deltas))
+    
+    def _filter_deltas(self, deltas):
+        return [(fromid, toid, amount, user_amount)
+                for (fromid, toid), (amount, user_amount) in deltas.iteritems()
+                if fromid is not None and toid is not None]
+    
+    def _store_transitions(self, deltas):
+        # Decaying scores are brought up to date as they are written
+        decay = " * decay(updated, excluded.updated)" if self.decay else ""
+        columns = {"table": self.table,
+                   "max_table": self.max_table,
+                   "fromfield_column": self.fromfield_column,
+                   "tofield_column": self.tofield_column,
+                   "decay": decay,
+                   "score": self.decayed("score")}
+        now = time.time()
+        
+        # Create each transition entry, or increment its scores if it already exists
+        with self.musicdb.transaction():
+            self.musicdb.executemany("""
+                INSERT
+                    INTO %(table)s (%(fromfield_column)s, %(tofield_column)s, score, userscore, updated)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (%(fromfield_column)s, %(tofield_column)s)
+                    DO UPDATE SET score=score%(decay)s+excluded.score, userscore=userscore%(decay)s+excluded.userscore,
+                                  updated=excluded.updated
+                """ % columns, ((fromid, toid, amount, user_amount, now) for fromid, toid, amount, user_amount in deltas))
             
-            # Increment the score of the transition by one
-            self.musicdb.execute("""
-                UPDATE %(table)s
-                    SET score=score+:amount, userscore=userscore+:user_amount
-                    WHERE %(fromfield_column)s=:fromid AND %(tofield_column)s=:toid
-                """ % {"table": self.table, "fromfield_column": self.fromfield_column, "tofield_column": self.tofield_column},
-                {"fromid": fromid, "toid": toid, "amount": amount, "user_amount": user_amount})
-    
\ No newline at end of file
+            # Raise the maximum score leaving each from value to the updated edges' scores. Lowering
+            # a score may lower the maximum, which then has to be recalculated from all of the edges.
+            self.musicdb.executemany("""
+                INSERT
+                    INTO %(max_table)s (%(fromfield_column)s, maxscore, updated)
+                    SELECT %(fromfield_column)s, score, updated FROM %(table)s
+                        WHERE %(fromfield_column)s=? AND %(tofield_column)s=?
+                    ON CONFLICT (%(fromfield_column)s)
+                    DO UPDATE SET maxscore=MAX(maxscore%(decay)s, excluded.maxscore), updated=excluded.updated
+                """ % columns, ((fromid, toid) for fromid, toid, amount, user_amount in deltas if amount >= 0))
+            
+            self.musicdb.executemany("""
+                INSERT OR REPLACE
+                    INTO %(max_table)s (%(fromfield_column)s, maxscore, updated)
+                    SELECT %(fromfield_column)s, MAX(%(score)s), :now FROM %(table)s
+                        WHERE %(fromfield_column)s=:fromvalue
+                """ % columns, [{"fromvalue": fromid, "now": now}
+                                for fromid in set(fromid for fromid, toid, amount, user_amount in deltas if amount < 0)])
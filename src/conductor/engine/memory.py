@@ -0,0 +1,146 @@
+import logging
+import array
+import threading
+
+from ..musicdb import CatalogTable
+
+_log = logging.getLogger("conductor.memory")
+
+class MemoryModel:
+    """An in-memory mirror of the track catalog, used to score transitions without SQL.
+    
+    The chain edges themselves are mirrored by each MarkovChain (see MarkovChain.load_edges); the
+    model holds a columnar table of the track fields that chains refer to, plus reverse indexes
+    from each field value to the tracks which have it.
+    
+    """
+    fields = CatalogTable.fields
+    
+    def __init__(self, musicdb, catalog=None):
+        self.musicdb = musicdb
+        self.catalog = catalog if catalog is not None else CatalogTable(musicdb)
+        self.indexes = dict((field, {}) for field in self.fields)
+        self.indexed = 0
+        self.lock = threading.Lock()
+    
+    def load(self):
+        _log.info("Loading track catalog into memory.")
+        
+        with self.lock:
+            self.catalog.load()
+            for index in self.indexes.values():
+                index.clear()
+            self.indexed = 0
+            self._index_tracks()
+    
+    def sync(self):
+        """Load any tracks that have been added to the database since the last sync."""
+        with self.lock:
+            self.catalog.sync()
+            self._index_tracks()
+    
+    def _index_tracks(self):
+        columns = self.catalog.columns
+        ids = columns["trackid"]
+        count = len(ids)
+        for field, index in self.indexes.iteritems():
+            column = columns[field]
+            for position in xrange(self.indexed, count):
+                value = column[position]
+                if value:
+                    trackids = index.get(value)
+                    if trackids is None:
+                        trackids = index[value] = array.array("l")
+                    trackids.append(ids[position])
+        self.indexed = count
+    
+    def get_scores(self, fromid, chains, config):
+        """Sum the chain scores of every track following the given track id.
+        
+        This is an equivalent of the scoring query in MarkovConductor.get_transitions_from_id.
+        
+        Returns: a list of the form [ (trackid, totalscore, totaluserscore), .. ]
+        
+        """
+        adjusted = self.get_adjustments(fromid, chains, config)
+        if adjusted is None:
+            return []
+        base_score, base_userscore, adjustments = adjusted
+        
+        scores = []
+        for trackid in self._track_ids():
+            adjustment = adjustments.get(trackid)
+            if adjustment:
+                scores.append((trackid, base_score + adjustment[0], base_userscore + adjustment[1]))
+            else:
+                scores.append((trackid, base_score, base_userscore))
+        return scores
+    
+    def _track_ids(self):
+        return self.catalog.ids[:self.indexed]
+    
+    def get_adjustments(self, fromid, chains, config):
+        """Score the tracks following the given track id which differ from the default score.
+        
+        Every track starts with the default score of each chain; only the tracks matched by an edge
+        leaving the current track are adjusted individually, so this takes time proportional to the
+        number of matched tracks rather than to the size of the catalog.
+        
+        Returns: a tuple of the form (base_score, base_userscore, { trackid: [score_delta, userscore_delta] }),
+                 or None if the track id is unknown
+        
+        """
+        fromtrack = None
+        if fromid:
+            fromtrack = self.catalog.get_fields(fromid)
+            if fromtrack is None:
+                return None
+        # After the lookup, which loads a track added over another connection
+        self.sync()
+        
+        default_score = config["default_score"]
+        default_userscore = config["default_userscore"]
+        min_userscore = config["min_userscore"]
+        max_userscore = config["max_userscore"]
+        
+        base_score = 0.0
+        base_userscore = 0
+        adjustments = {}
+        for chain in chains:
+            fromvalue = fromtrack[chain.fromfield] if fromtrack else -1
+            edges = chain.get_edges(fromvalue)
+            
+            # Scores are normalized by the largest score leaving the current field value
+            if edges:
+                maxscore = chain.get_maximum(fromvalue)
+                if maxscore is None:
+                    # The edges may have just been added by another thread
+                    maxscore = max(edge[0] for edge in edges.values())
+                divisor = float(max(config["min_score_divisor"], maxscore))
+            else:
+                divisor = 1.0
+            
+            base_score += default_score / divisor
+            base_userscore += default_userscore
+            
+            if not edges:
+                continue
+            
+            index = self.indexes[chain.tofield]
+            for tovalue, edge in edges.items():
+                trackids = index.get(tovalue)
+                if not trackids:
+                    continue
+                
+                score, userscore = edge[0], edge[1]
+                score_delta = (score - default_score) / divisor
+                userscore_delta = max(min_userscore, min(max_userscore, userscore)) - default_userscore
+                for trackid in trackids:
+                    adjustment = adjustments.get(trackid)
+                    if adjustment is None:
+                        adjustments[trackid] = [score_delta, userscore_delta]
+                    else:
+                        adjustment[0] += score_delta
+                        adjustment[1] += userscore_delta
+        
+        return base_score, base_userscore, adjustments
@@ -0,0 +1,146 @@
+"""Rebuilding chain scores by replaying the listening history.
+
+Every transition in the history adds its score (user_choice_score or markov_choice_score) to the
+edge between the from value of its source track (-1 at the start of a session) and the to value of
+its destination, and its user score to the same edge. Entries expired into daily counts (see
+MusicHistory.expire) are replayed from those counts. Decaying scores are decayed from the time of
+each entry (midday, for daily counts) to the start of the rebuild.
+
+The history is summed by pairs of values in SQL, over ranges of history ids which are spread over a
+pool of processes for large histories. Each process reads from a connection of its own, so that the
+conductor keeps serving from the previous scores meanwhile. The ranges end at the last entry when
+the rebuild started; entries recorded since are added as the sums are loaded, in one transaction.
+
+The history only keeps the last feedback on each entry, so replayed user scores may differ from
+those built up as feedback was given.
+
+"""
+from __future__ import with_statement
+
+import time
+import logging
+import datetime
+import multiprocessing
+from pysqlite2 import dbapi2 as sqlite3
+
+from decay import decay_function
+
+_log = logging.getLogger("conductor.rebuild")
+
+# Sums of the scores of a range of history entries, by pair of chain values
+HISTORY_SQL = """
+    SELECT CASE WHEN history.fromtrackid IS NULL THEN -1 ELSE fromtrack.%(fromfield)s END AS fromvalue,
+           totrack.%(tofield)s AS tovalue,
+           SUM(CASE WHEN history.userchoice THEN :user_choice_score ELSE :markov_choice_score END%(decay)s),
+           SUM(history.userscore%(decay)s)
+        FROM history
+            LEFT JOIN track fromtrack ON (fromtrack.trackid=history.fromtrackid)
+            JOIN track totrack ON (totrack.trackid=history.totrackid)
+        WHERE history.historyid BETWEEN :first AND :last
+        GROUP BY fromvalue, tovalue
+        HAVING fromvalue IS NOT NULL AND tovalue IS NOT NULL
+    """
+
+# Sums of the scores of the daily counts of expired entries, by pair of chain values
+ROLLUP_SQL = """
+    SELECT CASE WHEN history_daily.fromtrackid=0 THEN -1 ELSE fromtrack.%(fromfield)s END AS fromvalue,
+           totrack.%(tofield)s AS tovalue,
+           SUM((history_daily.userchoices * :user_choice_score +
+                (history_daily.transitions - history_daily.userchoices) * :markov_choice_score)%(decay)s),
+           SUM(history_daily.userscore%(decay)s)
+        FROM history_daily
+            LEFT JOIN track fromtrack ON (fromtrack.trackid=history_daily.fromtrackid)
+            JOIN track totrack ON (totrack.trackid=history_daily.totrackid)
+        GROUP BY fromvalue, tovalue
+        HAVING fromvalue IS NOT NULL AND tovalue IS NOT NULL
+    """
+
+# Decay of a score from the time of an entry to the start of the rebuild, in seconds of Julian days
+HISTORY_DECAY = " * decay(julianday(history.timestamp) * 86400.0, julianday(:started) * 86400.0)"
+ROLLUP_DECAY = " * decay((julianday(history_daily.day) + 0.5) * 86400.0, julianday(:started) * 86400.0)"
+
+def _aggregate(job):
+    """Run a summing query on a connection of its own, returning its rows (in a pool process)."""
+    path, sql, params, half_life = job
+    db = sqlite3.connect(path)
+    try:
+        db.execute("PRAGMA query_only=1")
+        if half_life:
+            db.create_function("decay", 2, decay_function(half_life))
+        return db.execute(sql, params).fetchall()
+    finally:
+        db.close()
+
+def _add(totals, rows):
+    for fromvalue, tovalue, score, userscore in rows:
+        total = totals.setdefault((fromvalue, tovalue), [0, 0])
+        total[0] += score or 0
+        total[1] += userscore or 0
+
+def _chain_sql(template, decay, chain, half_life):
+    return template % {"fromfield": chain.fromfield,
+                       "tofield": chain.tofield,
+                       "decay": decay if half_life else ""}
+
+def rebuild_chains(conductor, chains, processes=None, batch_size=100000):
+    """Rebuild the scores of a conductor's chains by replaying its history.
+    
+    The history is summed in ranges of batch_size entries, by a pool of processes (as many as
+    there are CPUs by default) when there is more than one range; with processes=1, the ranges
+    are summed in this process. This must not run while the history is expired (see maintain).
+    
+    Returns: the number of history entries replayed (besides the daily counts)
+    
+    """
+    musicdb = conductor.musicdb
+    config = conductor.config
+    half_life = config["half_life"]
+    started = time.time()
+    params = {"user_choice_score": config["user_choice_score"],
+              "markov_choice_score": config["markov_choice_score"],
+              "started": datetime.datetime.fromtimestamp(started)}
+    
+    first, last = musicdb.query("SELECT MIN(historyid), MAX(historyid) FROM history")[0]
+    _log.info("Rebuilding %s chains from history entries %s to %s.", len(chains), first, last)
+    
+    jobs = []
+    for chain in chains:
+        if last is not None:
+            sql = _chain_sql(HISTORY_SQL, HISTORY_DECAY, chain, half_life)
+            for start in xrange(first, last + 1, batch_size):
+                jobs.append((chain, sql, dict(params, first=start, last=min(start + batch_size - 1, last))))
+        jobs.append((chain, _chain_sql(ROLLUP_SQL, ROLLUP_DECAY, chain, half_life), params))
+    
+    args = [(musicdb.path, sql, job_params, half_life) for chain, sql, job_params in jobs]
+    if processes == 1 or len(jobs) <= 2 * len(chains):
+        results = map(_aggregate, args)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_aggregate, args)
+        finally:
+            pool.close()
+            pool.join()
+    
+    totals = dict((chain, {}) for chain in chains)
+    for (chain, sql, job_params), rows in zip(jobs, results):
+        _add(totals[chain], rows)
+    
+    # Replace the scores, adding the entries recorded meanwhile. Queued events are written first, as
+    # the write-behind queue takes its lock before the database's, and no more are queued until the
+    # in-memory mirror is reloaded.
+    with conductor._flushed():
+        with musicdb.transaction():
+            replayed = (last or 0) - (first or 1) + 1
+            end = musicdb.query("SELECT MAX(historyid) FROM history")[0][0]
+            if end is not None and end > last:
+                for chain in chains:
+                    _add(totals[chain], musicdb.query(_chain_sql(HISTORY_SQL, HISTORY_DECAY, chain, half_life),
+                                                      dict(params, first=(last or 0) + 1, last=end)))
+                replayed += end - (last or 0)
+        
+            for chain in chains:
+                chain.replace_edges(totals[chain], started)
+    
+    _log.info("Rebuilt %s chains in %.1f seconds.", len(chains), time.time() - started)
+    return replayed
@@ -0,0 +1,47 @@
+import random
+
+class AliasTable:
+    """A Walker alias table, sampling from a fixed weight distribution in constant time.
+    
+    Building the table is linear in the number of choices, so it should be cached for as long as
+    the weights remain unchanged.
+    
+    """
+    def __init__(self, weight_dict):
+        if not weight_dict:
+            raise ValueError("Cannot sample from an empty distribution.")
+        
+        items = weight_dict.items()
+        self.ids = [id for id, weight in items]
+        
+        count = len(items)
+        total = float(sum(weight for id, weight in items))
+        if total > 0:
+            scaled = [weight * count / total for id, weight in items]
+        else:
+            scaled = [1.0] * count
+        
+        # Pair each under-full column with an over-full one which tops it up
+        self.prob = [1.0] * count
+        self.alias = range(count)
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            l = large[-1]
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(large.pop())
+        
+    def __len__(self):
+        return len(self.ids)
+    
+    def sample(self, rng=random):
+        r = rng.random() * len(self.ids)
+        index = min(int(r), len(self.ids) - 1)
+        if r - index < self.prob[index]:
+            return self.ids[index]
+        else:
+            return self.ids[self.alias[index]]
@@ -0,0 +1,329 @@
+"""Compact binary snapshots of a conductor's model, memory-mapped by read-only conductors.
+
+A snapshot holds the columnar track catalog, an index from each field value to the tracks with it,
+and every chain in compressed sparse row form: the sorted from values of the chain, the offset of
+the edges leaving each of them, and the to values, scores and user scores of the edges.
+
+The file starts with a magic string, the format version and the length of a JSON header, which
+describes where each array lies in the data that follows. Arrays are little-endian 64-bit integers
+(or, for scores, floats) aligned to 8 bytes, so that they can be used in place from a shared memory
+map. Decaying scores are stored as of the time the snapshot was written.
+
+Snapshots are written to a temporary file which is then renamed over the previous snapshot, so
+readers always see a whole snapshot, and can switch to a new one whenever it is published.
+
+"""
+from __future__ import with_statement
+
+import os
+import mmap
+import json
+import struct
+import time
+import bisect
+import logging
+import datetime
+
+from ..musicdb import CatalogTable
+from memory import MemoryModel
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_log = logging.getLogger("conductor.snapshot")
+
+MAGIC = "CNDSNAP\0"
+FORMAT_VERSION = 2
+PREAMBLE = struct.Struct("<8sII")
+ITEM_SIZE = 8
+
+# NumPy types of the array formats, which are struct format characters
+DTYPES = {"q": "<i8", "d": "<f8"}
+
+def write_snapshot(path, catalog, chains):
+    """Write a snapshot of a catalog table and of a list of chains, replacing any previous one.
+    
+    Returns the generation of the new snapshot, which is one more than that of the previous.
+    
+    """
+    arrays = []
+    def add(values, format="q"):
+        arrays.append((values, format))
+        return len(arrays) - 1
+    
+    catalog.sync()
+    columns = dict((field, list(catalog.columns[field])) for field in catalog.fields)
+    header = {"fields": list(catalog.fields),
+              "tracks": len(columns["trackid"]),
+              "catalog": dict((field, add(column)) for field, column in columns.iteritems()),
+              "indexes": {},
+              "chains": []}
+    
+    # Index the tracks by each field value
+    for field in catalog.fields:
+        pairs = sorted((value, trackid) for value, trackid in zip(columns[field], columns["trackid"]) if value)
+        values, offsets = _compress([value for value, trackid in pairs])
+        header["indexes"][field] = {"values": add(values),
+                                    "offsets": add(offsets),
+                                    "trackids": add([trackid for value, trackid in pairs])}
+    
+    now = time.time()
+    for chain in chains:
+        edges = chain.musicdb.query("""
+            SELECT %(fromfield_column)s, %(tofield_column)s, %(score)s, %(userscore)s FROM %(table)s
+                WHERE %(fromfield_column)s IS NOT NULL AND %(tofield_column)s IS NOT NULL
+                ORDER BY %(fromfield_column)s, %(tofield_column)s
+            """ % {"table": chain.table,
+                   "fromfield_column": chain.fromfield_column,
+                   "tofield_column": chain.tofield_column,
+                   "score": chain.decayed("score"),
+                   "userscore": chain.decayed("userscore")},
+            {"now": now})
+        
+        fromvalues, offsets = _compress([row[0] for row in edges])
+        scores = [float(row[2] or 0) for row in edges]
+        maxima = [max(scores[offsets[i]:offsets[i + 1]]) for i in xrange(len(fromvalues))]
+        header["chains"].append({"fromfield": chain.fromfield,
+                                 "tofield": chain.tofield,
+                                 "from": add(fromvalues),
+                                 "offsets": add(offsets),
+                                 "maxima": add(maxima, "d"),
+                                 "to": add([row[1] for row in edges]),
+                                 "scores": add(scores, "d"),
+                                 "userscores": add([float(row[3] or 0) for row in edges], "d")})
+    
+    generation = 1
+    if os.path.exists(path):
+        try:
+            generation = Snapshot(path).generation + 1
+        except (IOError, ValueError):
+            _log.warning("Replacing unreadable snapshot at %s.", path)
+    header["generation"] = generation
+    header["created"] = datetime.datetime.now().isoformat()
+    
+    # Lay the arrays out one after another
+    position = 0
+    layout = []
+    for values, format in arrays:
+        layout.append([position, len(values), format])
+        position += len(values) * ITEM_SIZE
+    header["arrays"] = layout
+    
+    encoded = json.dumps(header)
+    encoded += " " * (-(PREAMBLE.size + len(encoded)) % ITEM_SIZE)
+    
+    temp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+        f.write(encoded)
+        for values, format in arrays:
+            f.write(struct.pack("<%s%s" % (len(values), format), *values))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+    
+    _log.info("Wrote snapshot generation %s to %s.", generation, path)
+    return generation
+
+def _compress(keys):
+    """Compress a sorted list of keys into its distinct keys, and the offsets where each starts.
+    
+    The offsets have one more entry than the keys, marking the end of the last run.
+    
+    """
+    values = []
+    offsets = []
+    for position, key in enumerate(keys):
+        if not values or values[-1] != key:
+            values.append(key)
+            offsets.append(position)
+    offsets.append(len(keys))
+    return values, offsets
+
+def _values(array):
+    """Convert a slice of a snapshot array to a list of ints."""
+    if hasattr(array, "tolist"):
+        return array.tolist()
+    return array
+
+class MappedArray:
+    """A read-only array of 64-bit values within a memory map, used when NumPy is not available."""
+    
+    def __init__(self, buffer, offset, length, format="q"):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+        self.item = struct.Struct("<" + format)
+    
+    def __len__(self):
+        return self.length
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("Mapped array index out of range.")
+        return self.item.unpack_from(self.buffer, self.offset + index * ITEM_SIZE)[0]
+    
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self[i]
+
+class Snapshot:
+    """A memory-mapped snapshot file."""
+    
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic, version, length = PREAMBLE.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a conductor snapshot." % path)
+        if version != FORMAT_VERSION:
+            raise ValueError("Snapshot %s has format version %s; version %s is supported."
+                             % (path, version, FORMAT_VERSION))
+        
+        self.header = json.loads(self.map[PREAMBLE.size:PREAMBLE.size + length])
+        self.generation = self.header["generation"]
+        self.start = PREAMBLE.size + length
+    
+    def array(self, index):
+        offset, length, format = self.header["arrays"][index]
+        if numpy is not None:
+            return numpy.frombuffer(self.map, dtype=DTYPES[format], count=length, offset=self.start + offset)
+        return MappedArray(self.map, self.start + offset, length, str(format))
+    
+    def is_current(self):
+        """Check whether the snapshot is still the one published at its path."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_ino, stat.st_mtime, stat.st_size) == self.identity
+
+class SnapshotCatalog(CatalogTable):
+    """A catalog table backed by the arrays of a snapshot."""
+    
+    def __init__(self, snapshot):
+        CatalogTable.__init__(self, None)
+        self.columns = dict((field, snapshot.array(index)) for field, index in snapshot.header["catalog"].iteritems())
+    
+    def load(self):
+        pass
+    
+    def sync(self):
+        pass
+    
+    def _position(self, trackid, sync=False):
+        ids = self.ids
+        position = bisect.bisect_left(ids, trackid)
+        if position < len(ids) and ids[position] == trackid:
+            return position
+    
+    def get(self, trackid, field):
+        value = CatalogTable.get(self, trackid, field)
+        return int(value) if value is not None else None
+    
+    def get_fields(self, trackid):
+        fields = CatalogTable.get_fields(self, trackid)
+        if fields is not None:
+            return dict((field, int(value) if value is not None else None) for field, value in fields.iteritems())
+
+class SnapshotIndex:
+    """Maps the values of a field to the tracks with it, within a snapshot."""
+    
+    def __init__(self, snapshot, arrays):
+        self.values = snapshot.array(arrays["values"])
+        self.offsets = snapshot.array(arrays["offsets"])
+        self.trackids = snapshot.array(arrays["trackids"])
+    
+    def get(self, value, default=None):
+        position = bisect.bisect_left(self.values, value)
+        if position < len(self.values) and self.values[position] == value:
+            return _values(self.trackids[self.offsets[position]:self.offsets[position + 1]])
+        return default
+
+class SnapshotChain:
+    """A read-only chain backed by the arrays of a snapshot."""
+    
+    def __init__(self, snapshot, arrays):
+        self.fromfield = str(arrays["fromfield"])
+        self.tofield = str(arrays["tofield"])
+        self.fromvalues = snapshot.array(arrays["from"])
+        self.offsets = snapshot.array(arrays["offsets"])
+        self.maxima = snapshot.array(arrays["maxima"])
+        self.tovalues = snapshot.array(arrays["to"])
+        self.scores = snapshot.array(arrays["scores"])
+        self.userscores = snapshot.array(arrays["userscores"])
+        
+        # Edges are read straight from the arrays, rather than from an in-memory mirror
+        self.edges = None
+    
+    def _position(self, fromvalue):
+        position = bisect.bisect_left(self.fromvalues, fromvalue)
+        if position < len(self.fromvalues) and self.fromvalues[position] == fromvalue:
+            return position
+    
+    def get_edges(self, fromvalue):
+        position = self._position(fromvalue)
+        if position is None:
+            return None
+        
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        return dict((int(toid), [float(score), float(userscore)])
+                    for toid, score, userscore in zip(self.tovalues[start:end],
+                                                      self.scores[start:end],
+                                                      self.userscores[start:end]))
+    
+    def get_maximum(self, fromvalue):
+        position = self._position(fromvalue)
+        if position is not None:
+            return float(self.maxima[position])
+
+class SnapshotModel(MemoryModel):
+    """A model scoring transitions from a memory-mapped snapshot.
+    
+    The model switches to a newer snapshot when one is published at the same path; reload()
+    reports when it did, so that anything derived from the previous snapshot can be dropped.
+    
+    """
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = None
+        self.chains = {}
+    
+    def load(self):
+        snapshot = Snapshot(self.path)
+        _log.info("Loading snapshot generation %s from %s.", snapshot.generation, self.path)
+        
+        self.catalog = SnapshotCatalog(snapshot)
+        self.indexes = dict((field, SnapshotIndex(snapshot, arrays))
+                            for field, arrays in snapshot.header["indexes"].iteritems())
+        self.indexed = snapshot.header["tracks"]
+        self.chains = dict(((chain.fromfield, chain.tofield), chain)
+                           for chain in (SnapshotChain(snapshot, arrays) for arrays in snapshot.header["chains"]))
+        self.snapshot = snapshot
+    
+    def reload(self):
+        """Switch to a newer snapshot if one has been published, returning whether it did."""
+        if self.snapshot.is_current():
+            return False
+        self.load()
+        return True
+    
+    @property
+    def generation(self):
+        return self.snapshot.generation
+    
+    def sync(self):
+        pass
+    
+    def _track_ids(self):
+        return _values(self.catalog.ids[:self.indexed])
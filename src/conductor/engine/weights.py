@@ -0,0 +1,79 @@
+"""Weight functions turning summed chain scores into track selection weights.
+
+A scalar weight function has the signature (conductor, score, user_score) and returns a single
+weight. A batch weight function is marked with a true "batch" attribute and has the signature
+(conductor, scores, user_scores), taking and returning whole sequences of values at once.
+
+"""
+import math
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def batch_weight_function(func):
+    """Wrap a weight function so that it evaluates whole sequences of scores at once.
+    
+    Batch weight functions are returned unchanged; scalar weight functions are called once per
+    score by an adapter.
+    
+    """
+    if getattr(func, "batch", False):
+        return func
+    
+    def adapter(conductor, scores, user_scores):
+        return [func(conductor, score, user_score) for score, user_score in izip(scores, user_scores)]
+    adapter.batch = True
+    adapter.scalar = func
+    return adapter
+
+def vectorized(scalar):
+    """Declare a NumPy implementation of a scalar weight function.
+    
+    The decorated function receives the scores as float arrays. When NumPy is not available, the
+    scalar function is called once per score instead.
+    
+    """
+    def decorator(func):
+        def wrapper(conductor, scores, user_scores):
+            if numpy is None:
+                return [scalar(conductor, score, user_score) for score, user_score in izip(scores, user_scores)]
+            return func(conductor, numpy.asarray(scores, dtype=float), numpy.asarray(user_scores, dtype=float))
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.batch = True
+        wrapper.scalar = scalar
+        return wrapper
+    return decorator
+
+def _ease(x, length, height):
+    return (math.tanh(x*(math.pi/length))+1)*(height/2)
+
+def calculate_weight_scalar(conductor, score, user_score):
+    return math.exp(user_score) * math.exp(score*4)
+
+def calculate_weight_conservative_scalar(conductor, score, user_score):
+    num_chains = len(conductor.chains)
+    return _ease(user_score, 10 * num_chains, 10) * math.pow(2, score)
+
+def calculate_weight_eager_scalar(conductor, score, user_score):
+    return math.pow(1 + (1.0/len(conductor.chains)), user_score) * (math.sqrt(score) + 1)
+
+@vectorized(calculate_weight_scalar)
+def calculate_weight(conductor, scores, user_scores):
+    """Calculate weightings based on inferred scores and user-specified scores"""
+    return numpy.exp(user_scores) * numpy.exp(scores*4)
+
+@vectorized(calculate_weight_conservative_scalar)
+def calculate_weight_conservative(conductor, scores, user_scores):
+    """Weight user scores along a bounded curve, doubling the weight for each point of score."""
+    num_chains = len(conductor.chains)
+    length = 10 * num_chains
+    return (numpy.tanh(user_scores*(math.pi/length))+1)*(10/2) * numpy.power(2, scores)
+
+@vectorized(calculate_weight_eager_scalar)
+def calculate_weight_eager(conductor, scores, user_scores):
+    """Weight user scores exponentially, growing the weight with the square root of the score."""
+    return numpy.power(1 + (1.0/len(conductor.chains)), user_scores) * (numpy.sqrt(scores) + 1)
@@ -0,0 +1,280 @@
+from __future__ import with_statement
+
+import os
+import json
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+
+_log = logging.getLogger("conductor.writebehind")
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+class TransitionEvent(object):
+    __slots__ = ("seq", "timestamp", "fromtrack", "totrack", "userchoice", "historyid")
+    
+    def __init__(self, seq, timestamp, fromtrack, totrack, userchoice):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.fromtrack = fromtrack
+        self.totrack = totrack
+        self.userchoice = userchoice
+        
+        # The id of the history entry, once the event has been written
+        self.historyid = None
+
+class FeedbackEvent(object):
+    __slots__ = ("seq", "transition", "target", "liked")
+    
+    def __init__(self, seq, transition, target, liked):
+        self.seq = seq
+        self.transition = transition
+        
+        # The history id of the transition, or its TransitionEvent while it is still pending
+        self.target = target
+        self.liked = liked
+    
+    @property
+    def historyid(self):
+        if isinstance(self.target, TransitionEvent):
+            return self.target.historyid
+        return self.target
+
+class WriteBehindQueue:
+    """Queues transition and feedback events, writing them to the database in batches.
+    
+    Events are written by a background thread once flush_size events are pending, or after
+    flush_interval seconds. When a journal path is given, every event is also appended to the
+    journal as it is queued, and any events which were not written before a crash are replayed
+    when the queue is started again.
+    
+    The queue only takes care of the database; the conductor applies each event to its in-memory
+    model as it is queued, so that pending events are taken into account when choosing tracks.
+    
+    """
+    def __init__(self, conductor, flush_size=256, flush_interval=1.0, journal=None):
+        self.conductor = conductor
+        self.musicdb = conductor.musicdb
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.journal = journal
+        
+        self.events = []
+        self.seq = 0
+        self.last_timestamp = None
+        self.condition = threading.Condition()
+        
+        # Held while events are written; writers of the database taking it along with the
+        # database's lock must take it first
+        self.flush_lock = threading.RLock()
+        self.journal_file = None
+        self.thread = None
+        self.stopping = False
+    
+    def init(self):
+        self.musicdb.migrate("writebehind", self.migrations())
+    
+    def migrations(self):
+        return [self._init_schema]
+    
+    def _init_schema(self):
+        with self.musicdb.transaction():
+            self.musicdb.execute("""
+                CREATE TABLE IF NOT EXISTS journal (
+                    path TEXT PRIMARY KEY,
+                    seq INTEGER NOT NULL
+                )""")
+    
+    def start(self):
+        """Start writing queued events in the background, returning any events replayed from the journal."""
+        self.init()
+        if self.journal:
+            self._replay()
+            self.journal_file = open(self.journal, "a")
+        
+        replayed = list(self.events)
+        
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="conductor-writebehind")
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return replayed
+    
+    def stop(self):
+        """Write any pending events and stop the background thread."""
+        if self.thread:
+            with self.condition:
+                self.stopping = True
+                self.condition.notify()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        if self.journal_file:
+            self.journal_file.close()
+            self.journal_file = None
+    
+    def record_transition(self, fromtrack, totrack, userchoice):
+        """Queue a transition, returning its event (which stands in for its history id)."""
+        with self.condition:
+            timestamp = datetime.datetime.now()
+            if self.last_timestamp and timestamp <= self.last_timestamp:
+                timestamp = self.last_timestamp + datetime.timedelta(microseconds=1)
+            self.last_timestamp = timestamp
+            
+            return self._put(TransitionEvent(self._next_seq(), timestamp, fromtrack, totrack, userchoice))
+    
+    def record_user_feedback(self, transition, historyid, liked):
+        """Queue feedback on a transition, given its history id or pending event."""
+        if isinstance(historyid, TransitionEvent) and historyid.historyid is not None:
+            historyid = historyid.historyid
+        
+        with self.condition:
+            return self._put(FeedbackEvent(self._next_seq(), transition, historyid, liked))
+    
+    def _next_seq(self):
+        self.seq += 1
+        return self.seq
+    
+    def _put(self, event):
+        if self.journal_file:
+            self.journal_file.write(json.dumps(self._encode(event)) + "\n")
+            self.journal_file.flush()
+        
+        self.events.append(event)
+        if len(self.events) >= self.flush_size:
+            self.condition.notify()
+        return event
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.stopping and len(self.events) < self.flush_size:
+                    self.condition.wait(self.flush_interval)
+                if self.stopping:
+                    return
+            
+            try:
+                self.flush()
+            except Exception:
+                _log.exception("Error while writing queued events.")
+    
+    def flush(self):
+        """Write all of the pending events to the database in a single transaction."""
+        with self.flush_lock:
+            with self.condition:
+                events = self.events
+                if not events:
+                    return
+                self.events = []
+                self._rotate_journal()
+            
+            _log.debug("Writing %s queued events.", len(events))
+            try:
+                with self.musicdb.transaction():
+                    self.conductor._write_events(events)
+                    if self.journal:
+                        self.musicdb.execute("INSERT OR REPLACE INTO journal (path, seq) VALUES (?, ?)",
+                                             (os.path.abspath(self.journal), events[-1].seq))
+            except:
+                # Keep the events (and the journal of them) to retry with the next batch
+                with self.condition:
+                    self.events[0:0] = events
+                raise
+            
+            if self.journal and os.path.exists(self.journal + ".flushing"):
+                os.unlink(self.journal + ".flushing")
+    
+    @contextmanager
+    def held(self):
+        """Write all of the pending events, holding off queueing or writing any more until the block exits."""
+        with self.flush_lock:
+            with self.condition:
+                self.flush()
+                yield
+    
+    def _rotate_journal(self):
+        """Set the journal of the events being written aside, starting a new one."""
+        if not self.journal_file:
+            return
+        
+        self.journal_file.close()
+        flushing = self.journal + ".flushing"
+        if os.path.exists(flushing):
+            # A previous batch failed to be written; keep its events in front of the new ones
+            with open(flushing, "a") as out:
+                with open(self.journal) as journal:
+                    out.write(journal.read())
+            os.unlink(self.journal)
+        else:
+            os.rename(self.journal, flushing)
+        self.journal_file = open(self.journal, "a")
+    
+    def _replay(self):
+        """Queue the journaled events which were never written to the database."""
+        rows = self.musicdb.execute("SELECT seq FROM journal WHERE path=?",
+                                    (os.path.abspath(self.journal),)).fetchall()
+        written = rows[0]["seq"] if rows else 0
+        self.seq = written
+        
+        transitions = {}
+        for path in (self.journal + ".flushing", self.journal):
+            if not os.path.exists(path):
+                continue
+            for line in open(path):
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # The last line may have been cut short by the crash
+                    continue
+                self.seq = max(self.seq, data["seq"])
+                if data["seq"] > written:
+                    event = self._decode(data, transitions)
+                    if isinstance(event, TransitionEvent):
+                        transitions[event.seq] = event
+                        self.last_timestamp = event.timestamp
+                    self.events.append(event)
+        
+        # The journal of the replayed events is kept until they are written by the next flush
+        _log.info("Replaying %s journaled events.", len(self.events))
+    
+    def _encode(self, event):
+        if isinstance(event, TransitionEvent):
+            return {"seq": event.seq,
+                    "event": "transition",
+                    "timestamp": event.timestamp.strftime(TIMESTAMP_FORMAT),
+                    "from": event.fromtrack.id if event.fromtrack else None,
+                    "to": event.totrack.id,
+                    "userchoice": event.userchoice}
+        
+        fromtrack, totrack = event.transition
+        data = {"seq": event.seq,
+                "event": "feedback",
+                "from": fromtrack.id if fromtrack else None,
+                "to": totrack.id,
+                "liked": event.liked}
+        if isinstance(event.target, TransitionEvent):
+            data["transition"] = event.target.seq
+            data["timestamp"] = event.target.timestamp.strftime(TIMESTAMP_FORMAT)
+        else:
+            data["historyid"] = event.target
+        return data
+    
+    def _decode(self, data, transitions):
+        get_track = self.musicdb.get_track_by_id
+        fromtrack = get_track(data["from"]) if data["from"] else None
+        totrack = get_track(data["to"])
+        
+        if data["event"] == "transition":
+            timestamp = datetime.datetime.strptime(data["timestamp"], TIMESTAMP_FORMAT)
+            return TransitionEvent(data["seq"], timestamp, fromtrack, totrack, data["userchoice"])
+        
+        target = data.get("historyid")
+        if "transition" in data:
+            target = transitions.get(data["transition"])
+            if target is None:
+                # The transition was written before the crash; find its entry by timestamp
+                timestamp = datetime.datetime.strptime(data["timestamp"], TIMESTAMP_FORMAT)
+                rows = self.musicdb.execute("SELECT rowid FROM history WHERE timestamp=?", (timestamp,)).fetchall()
+                target = rows[0][0] if rows else None
+        return FeedbackEvent(data["seq"], (fromtrack, totrack), target, data["liked"])
@@ -0,0 +1,105 @@
+from __future__ import with_statement
+
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+_log = logging.getLogger("conductor.stats")
+
+class Metrics:
+    """Counts, total and maximum times, and rows of named operations (e.g. SQL statements).
+    
+    A disabled instance records nothing, so that instrumented code costs next to nothing unless
+    profiling is turned on. The metrics are safe to share between threads.
+    
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.entries = {}
+        self.lock = threading.Lock()
+    
+    def record(self, name, elapsed, rows=None):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                entry = self.entries[name] = [0, 0.0, 0.0, None]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            if rows is not None:
+                entry[3] = (entry[3] or 0) + rows
+    
+    @contextmanager
+    def timer(self, name):
+        """Time the enclosed block as an operation of the given name."""
+        if not self.enabled:
+            yield
+            return
+        
+        start = timer()
+        try:
+            yield
+        finally:
+            self.record(name, timer() - start)
+    
+    def stats(self):
+        """Report the metrics of each operation, of the form { name: { "count": .., "time": .., .. } }.
+        
+        The rows are None for operations which never reported any.
+        
+        """
+        with self.lock:
+            return dict((name, {"count": count,
+                                "time": total,
+                                "mean_time": total / count,
+                                "max_time": maximum,
+                                "rows": rows})
+                        for name, (count, total, maximum, rows) in self.entries.iteritems())
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def timed(name):
+    """Decorate a method to be timed as an operation of the given name, in the metrics of its instance."""
+    def decorator(method):
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if not metrics.enabled:
+                return method(self, *args, **kwargs)
+            
+            start = timer()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.record(name, timer() - start)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorator
+
+class StatsLogger(threading.Thread):
+    """Periodically logs the statistics returned by a function, as JSON at the INFO level."""
+    
+    def __init__(self, stats, interval):
+        threading.Thread.__init__(self, name="conductor-stats")
+        self.setDaemon(True)
+        self.stats = stats
+        self.interval = interval
+        self.stopped = threading.Event()
+    
+    def run(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet():
+                return
+            try:
+                _log.info("Statistics: %s", json.dumps(self.stats(), sort_keys=True))
+            except Exception:
+                _log.exception("Error while collecting statistics.")
+    
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -1,40 +1,462 @@
 from __future__ import with_statement
 
+import os
+import csv
+import gzip
+import zlib
 import logging
 import datetime
+import array
+import bisect
+import threading
+import Queue
+from itertools import izip
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer as timer
 from pysqlite2 import dbapi2 as sqlite3
 
+from cache import LRUCache
+from metrics import Metrics
+
 _log = logging.getLogger("conductor.musicdb")
 
+# PRAGMA settings applied to each database connection, by profile name
+PRAGMA_PROFILES = {
+    # Write-ahead logging lets readers proceed during writes, and only syncs on checkpoints. Free
+    # pages are only reclaimed by maintain(), rather than by rewriting the whole file
+    "default": {"auto_vacuum": "INCREMENTAL",
+                "journal_mode": "WAL",
+                "synchronous": "NORMAL",
+                "cache_size": -16000,
+                "mmap_size": 64 * 1024 * 1024,
+                "temp_store": "MEMORY"},
+    
+    # SQLite's own defaults: a rollback journal, synced on every commit
+    "durable": {"journal_mode": "DELETE",
+                "synchronous": "FULL"},
+    
+    # For one-off imports into a scratch database: a crash may corrupt the database
+    "bulk": {"journal_mode": "MEMORY",
+             "synchronous": "OFF",
+             "cache_size": -256000,
+             "temp_store": "MEMORY"},
+}
+
+# PRAGMA settings stored in the database file, which read-only connections leave as they are
+FILE_PRAGMAS = ("auto_vacuum", "journal_mode")
+
 class MusicDB:
     
-    def __init__(self, path):
+    def __init__(self, path, pragmas="default", cache_size=4096, pool_size=0, profile=False, slow_query_time=None,
+                 readonly=False):
+        """Create a music database at the given path.
+        
+        pragmas is either the name of a profile in PRAGMA_PROFILES, or a dictionary of PRAGMA
+        settings overriding the default profile. cache_size is the number of tracks (and of each of
+        albums, artists and genres) kept in the identity map of loaded objects.
+        
+        A pool_size above 0 makes the database safe to share between threads: writes are serialized
+        on a single writer connection, while read-only queries run on a pool of that many reader
+        connections. The database is put in WAL mode, so that reads never wait for writes.
+        
+        With profile enabled, the count, time and rows of each statement are recorded by SQL
+        template (see statement_stats). The query plan of any SELECT statement taking longer than
+        slow_query_time seconds is captured along with them.
+        
+        A readonly database only opens an existing schema, and refuses any write.
+        
+        """
         self.path = path
+        if isinstance(pragmas, basestring):
+            self.pragmas = PRAGMA_PROFILES[pragmas]
+        else:
+            self.pragmas = dict(PRAGMA_PROFILES["default"], **pragmas)
+        self.pool_size = pool_size
+        self.readonly = readonly
+        if pool_size:
+            self.pragmas = dict(self.pragmas, journal_mode="WAL")
         self.db = None
+        self.readers = None
         self.history = None
         
-    def load(self):
+        # Set while loading a database whose schema matches the fingerprint stored by the last load
+        self.schema_current = False
+        self.schema = None
+        
+        self.statements = Metrics(profile)
+        self.slow_query_time = slow_query_time
+        self.query_plans = {}
+        
+        # SQL functions defined on each connection, by name
+        self.functions = {}
+        
+        # Paths of the database files attached to each connection, by schema name
+        self.attached = {}
+        
+        # Guards the writer connection for the duration of each transaction
+        self.lock = threading.RLock()
+        self._transaction_depth = 0
+        self._transaction_owner = None
+        
+        # Incremented whenever a new catalog entry is inserted, so that in-memory
+        # mirrors of the catalog can tell when they need to resync.
+        self.catalog_version = 0
+        
+        # Identity map of loaded objects, keyed by id
+        self.tracks = LRUCache(cache_size)
+        self.things = {Album: LRUCache(cache_size),
+                       Artist: LRUCache(cache_size),
+                       Genre: LRUCache(cache_size)}
+        
+    def load(self, schema=None):
+        """Open the database, bringing its schema up to date.
+        
+        schema is a dictionary of the number of migrations of each other component stored in the
+        database (e.g. by a conductor). When given, the schema is fingerprinted by the number of
+        migrations of every component and by SQLite's schema cookie, which changes with any change
+        to the tables. If the fingerprint matches the one stored by store_fingerprint() after the
+        last load, no migrations are checked until then.
+        
+        """
         _log.info("Loading database file at %s.", self.path)
         
-        self.db = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-        self.db.row_factory = sqlite3.Row
-        self._init_schema()
+        self.db = self._connect(self.readonly)
         self.history = MusicHistory(self)
-        self.history.init()
+        if not self.readonly:
+            if schema is not None:
+                self.schema = dict(schema, musicdb=len(self.migrations()), history=len(self.history.migrations()))
+                self.schema_current = self._fingerprint() == self.execute("PRAGMA user_version").fetchone()[0]
+                if self.schema_current:
+                    _log.info("Schema fingerprint matches; skipping migrations.")
+            
+            if not self.schema_current:
+                self._init_schema_version()
+            self.migrate("musicdb", self.migrations())
+            self.history.init()
+        
+        if self.pool_size:
+            self.readers = Queue.Queue()
+            for i in xrange(self.pool_size):
+                self.readers.put(self._connect(readonly=True))
         
     def unload(self):
-        self.db.commit()
-        self.execute("VACUUM")
+        if self.readers:
+            while not self.readers.empty():
+                self.readers.get().close()
+            self.readers = None
+        
+        if not self.readonly:
+            self.db.commit()
         self.db.close()
+    
+    def migrations(self):
+        return [self._init_schema,
+                self._init_indexes]
+    
+    def _fingerprint(self):
+        cookie = self.execute("PRAGMA schema_version").fetchone()[0]
+        # PRAGMA user_version holds a signed 32-bit integer, where 0 means none was stored
+        return zlib.crc32(repr((sorted(self.schema.iteritems()), cookie))) & 0x7fffffff or 1
+    
+    def store_fingerprint(self):
+        """Finish loading the schema, storing its fingerprint for the next load if it has changed."""
+        if self.schema is not None and not self.schema_current:
+            self.execute("PRAGMA user_version=%d" % self._fingerprint())
+        self.schema_current = False
+    
+    def maintain(self, pages=None, full_vacuum=False):
+        """Reclaim free space and refresh the query planner's statistics.
+        
+        This is meant to be scheduled at quiet times, as it holds up other writers while it runs.
+        Up to pages free pages (by default, all of them) are released with an incremental vacuum.
+        Databases created without auto_vacuum=INCREMENTAL need one full_vacuum to enable it,
+        which rewrites the whole file. Attached files (see attach) are maintained along with it.
+        
+        """
+        _log.info("Maintaining database file at %s.", self.path)
+        
+        with self.lock:
+            self.db.commit()
+            
+            # Gathering statistics changes the schema cookie, so a fingerprint which was current is restored
+            fingerprinted = (self.schema is not None
+                             and self._fingerprint() == self.execute("PRAGMA user_version").fetchone()[0])
+            for schema in ["main"] + sorted(self.attached):
+                if full_vacuum:
+                    self.execute("PRAGMA %s.auto_vacuum=INCREMENTAL" % schema)
+                    self.execute("VACUUM %s" % schema)
+                elif self.execute("PRAGMA %s.auto_vacuum" % schema).fetchone()[0] == 2:
+                    # Each step of the statement frees one page
+                    self.execute("PRAGMA %s.incremental_vacuum(%d)" % (schema, pages or 0)).fetchall()
+                else:
+                    _log.warning("Skipping vacuum, as auto_vacuum is not enabled on %s.",
+                                 self.attached.get(schema, self.path))
+            
+            if sqlite3.sqlite_version_info >= (3, 18, 0):
+                self.execute("PRAGMA optimize")
+            else:
+                self.execute("ANALYZE")
+            if fingerprinted:
+                self.execute("PRAGMA user_version=%d" % self._fingerprint())
+            self.db.commit()
+            
+            for schema in ["main"] + sorted(self.attached):
+                if self.execute("PRAGMA %s.journal_mode" % schema).fetchone()[0].lower() == "wal":
+                    self.execute("PRAGMA %s.wal_checkpoint(TRUNCATE)" % schema)
+    
+    def _connect(self, readonly=False):
+        db = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                             check_same_thread=not self.pool_size)
+        db.row_factory = sqlite3.Row
+        for name, value in sorted(self.pragmas.iteritems()):
+            if not (readonly and name in FILE_PRAGMAS):
+                db.execute("PRAGMA %s=%s" % (name, value))
+        if readonly:
+            db.execute("PRAGMA query_only=1")
+        for name, (num_params, func) in self.functions.iteritems():
+            db.create_function(name, num_params, func)
+        for name, path in sorted(self.attached.iteritems()):
+            self._attach(db, name, path, readonly)
+        return db
+    
+    def _attach(self, db, name, path, readonly=False):
+        db.execute("ATTACH DATABASE ? AS %s" % name, (path,))
+        for pragma, value in sorted(self.pragmas.iteritems()):
+            if not (readonly and pragma in FILE_PRAGMAS):
+                db.execute("PRAGMA %s.%s=%s" % (name, pragma, value))
+    
+    def _each_connection(self, func):
+        """Call a function with the writer connection and then every reader, along with whether it is
+        read-only, once no transaction is open."""
+        with self.lock:
+            self.db.commit()
+            func(self.db, self.readonly)
+            if self.readers:
+                # Wait for every reader to be returned to the pool
+                readers = [self.readers.get() for i in xrange(self.pool_size)]
+                try:
+                    for db in readers:
+                        func(db, True)
+                finally:
+                    for db in readers:
+                        self.readers.put(db)
+    
+    def create_function(self, name, num_params, func):
+        """Define a SQL function implemented in Python, on every connection opened by load()."""
+        self.functions[name] = (num_params, func)
+    
+    def attach(self, name, path):
+        """Attach a database file to every connection, as the schema of the given name.
+        
+        The file is created if it does not exist, and takes the same PRAGMA settings as the main
+        database. Tables in it are named as name.table in SQL. Statements writing to several files
+        commit atomically, except in WAL mode, where each file commits on its own.
+        
+        """
+        if self.attached.get(name) == path:
+            return
+        
+        _log.info("Attaching database file at %s as %s.", path, name)
+        self._each_connection(lambda db, readonly: self._attach(db, name, path, readonly))
+        self.attached[name] = path
+    
+    def detach(self, name):
+        """Detach a database file attached by attach()."""
+        if name in self.attached:
+            _log.info("Detaching database %s.", name)
+            self._each_connection(lambda db, readonly: db.execute("DETACH DATABASE %s" % name))
+            del self.attached[name]
         
     def execute(self, sql, *params):
-        _log.debug("Executing SQL: {%s} %s", sql, repr(params))
-        return self.db.execute(sql, *params)
+        _log.debug("Executing SQL: {%s} %r", sql, params)
+        if not self.statements.enabled:
+            return self.db.execute(sql, *params)
+        
+        start = timer()
+        cursor = self.db.execute(sql, *params)
+        self._record_statement(self.db, sql, params, timer() - start, cursor.rowcount)
+        return cursor
+    
+    def executemany(self, sql, seq_of_params):
+        _log.debug("Executing SQL for many parameters: {%s}", sql)
+        if not self.statements.enabled:
+            return self.db.executemany(sql, seq_of_params)
+        
+        start = timer()
+        cursor = self.db.executemany(sql, seq_of_params)
+        self._record_statement(self.db, sql, None, timer() - start, cursor.rowcount)
+        return cursor
+    
+    def query(self, sql, *params):
+        """Execute a read-only query, returning all of the resulting rows.
+        
+        When a pool of reader connections is available, the query runs on one of them, unless the
+        current thread is within a transaction (whose uncommitted changes it should see).
+        
+        """
+        if not self.readers or self._transaction_depth and self._transaction_owner == threading.current_thread():
+            return self._query(self.db, sql, params)
+        
+        with self.reader() as db:
+            return self._query(db, sql, params)
+    
+    def _query(self, db, sql, params):
+        _log.debug("Querying SQL: {%s} %r", sql, params)
+        if not self.statements.enabled:
+            return db.execute(sql, *params).fetchall()
+        
+        start = timer()
+        rows = db.execute(sql, *params).fetchall()
+        self._record_statement(db, sql, params, timer() - start, len(rows))
+        return rows
+    
+    def _record_statement(self, db, sql, params, elapsed, rows):
+        """Record the metrics of a statement, capturing its query plan if it was slow."""
+        self.statements.record(sql, elapsed, rows if rows >= 0 else None)
+        
+        if (self.slow_query_time is not None and elapsed >= self.slow_query_time and params is not None
+                and sql not in self.query_plans and sql.lstrip().upper().startswith("SELECT")):
+            plan = db.execute("EXPLAIN QUERY PLAN " + sql, *params).fetchall()
+            self.query_plans[sql] = [row[-1] for row in plan]
+            _log.warning("Slow SQL statement (%.3fs): {%s} plan: %s", elapsed, sql, "; ".join(self.query_plans[sql]))
+    
+    def statement_stats(self):
+        """Report the metrics of each statement executed (with profile enabled), slowest first.
+        
+        Returns: a list of dictionaries with the keys sql, count, time, mean_time, max_time, rows
+                 (for queries, the rows returned; for other statements, the rows changed) and plan
+                 (the query plan of a slow query, or None)
+        
+        """
+        stats = []
+        for sql, entry in self.statements.stats().iteritems():
+            entry["sql"] = " ".join(sql.split())
+            entry["plan"] = self.query_plans.get(sql)
+            stats.append(entry)
+        stats.sort(key=lambda entry: entry["time"], reverse=True)
+        return stats
+    
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection from the pool (or the main connection, without a pool)."""
+        if not self.readers:
+            yield self.db
+            return
+        
+        db = self.readers.get()
+        try:
+            yield db
+        finally:
+            self.readers.put(db)
+    
+    @contextmanager
+    def transaction(self):
+        """Group the statements executed within the block into a single transaction.
+        
+        Transactions may be nested, in which case only the outermost block commits (or rolls back
+        on an exception). Other threads wait to begin a transaction until the outermost block exits.
+        
+        """
+        with self.lock:
+            self._transaction_depth += 1
+            self._transaction_owner = threading.current_thread()
+            try:
+                yield self.db
+            except:
+                self._transaction_depth -= 1
+                if not self._transaction_depth:
+                    self.db.rollback()
+                raise
+            else:
+                self._transaction_depth -= 1
+                if not self._transaction_depth:
+                    self.db.commit()
+    
+    @contextmanager
+    def _schema_transaction(self):
+        """Group the statements executed within the block into a single transaction, as transaction()
+        does, including statements changing the schema.
+        
+        The driver commits an open transaction before each such statement, so the connection is put in
+        autocommit mode, with the transaction begun and ended explicitly.
+        
+        """
+        with self.lock:
+            if self._transaction_depth:
+                # Within another transaction, which the driver would already have committed
+                with self.transaction() as db:
+                    yield db
+                return
+            
+            self.db.commit()
+            isolation_level = self.db.isolation_level
+            self.db.isolation_level = None
+            self._transaction_depth += 1
+            self._transaction_owner = threading.current_thread()
+            try:
+                self.execute("BEGIN")
+                try:
+                    yield self.db
+                except:
+                    self.execute("ROLLBACK")
+                    raise
+                else:
+                    self.execute("COMMIT")
+            finally:
+                self._transaction_depth -= 1
+                self.db.isolation_level = isolation_level
+    
+    def _init_schema_version(self, schema="main"):
+        with self.transaction():
+            self.execute("""
+                CREATE TABLE IF NOT EXISTS %s.schema_version (
+                    component TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )""" % schema)
+    
+    def get_schema_version(self, component, schema="main"):
+        row = self.execute("SELECT version FROM %s.schema_version WHERE component=:component" % schema,
+                           {"component": component}).fetchone()
+        return row["version"] if row else 0
+    
+    def set_schema_version(self, component, version, schema="main"):
+        if version:
+            self.execute("INSERT OR REPLACE INTO %s.schema_version (component, version) VALUES (:component, :version)"
+                         % schema, {"component": component, "version": version})
+        else:
+            self.execute("DELETE FROM %s.schema_version WHERE component=:component" % schema, {"component": component})
+    
+    def migrate(self, component, migrations, schema="main"):
+        """Bring the schema of a component up to date, upgrading existing databases in place.
+        
+        migrations is a list of functions, where the nth upgrades the schema from version n to n+1.
+        The first migration should create the component's tables, using IF NOT EXISTS so that it is
+        safe to apply to databases created before schema versions were stored.
+        
+        Each migration is applied in a transaction of its own along with its new version, so that a
+        migration which fails is rolled back entirely and applied again on the next load.
+        
+        The version is stored in the given schema, so that an attached file carries its own. The
+        fingerprint only covers the main database, so attached files are checked on every load.
+        
+        """
+        if self.schema_current and schema == "main":
+            return
+        
+        if schema != "main":
+            self._init_schema_version(schema)
+        version = self.get_schema_version(component, schema)
+        for version in xrange(version, len(migrations)):
+            _log.info("Migrating %s schema to version %s.", component, version + 1)
+            with self._schema_transaction():
+                migrations[version]()
+                self.set_schema_version(component, version + 1, schema)
     
     def _init_schema(self):
         _log.info("Initializing database schema.")
         
-        with self.db:           
+        with self.transaction():
             self.execute("""
                 CREATE TABLE IF NOT EXISTS artist (
                     artistid INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -66,49 +488,72 @@ class MusicDB:
                     UNIQUE(name, albumid, artistid)
                 )""")
             
-            # TODO: add indexes here?
+    def _init_indexes(self):
+        with self.transaction():
+            self.execute("CREATE INDEX IF NOT EXISTS album_name ON album (name)")
+            self.execute("CREATE INDEX IF NOT EXISTS genre_name ON genre (name)")
             
     def _get_thing_id(self, selectsql, insertsql, add, params):
-        with self.db:
+        # Existing rows are looked up without waiting for writers; the writer connection is
+        # only needed to insert a missing row (unless another thread has inserted it meanwhile)
+        rows = self.query(selectsql, params)
+        if rows:
+            return rows[0]
+        if not add:
+            return None
+        
+        with self.transaction():
             result = self.execute(selectsql, params).fetchone()
-            
             if not result:
-                if add:
-                    id = self.execute(insertsql, params).lastrowid
-                    result = self.execute(selectsql, params).fetchone()
-                else:
-                    return None
+                self.execute(insertsql, params)
+                self._catalog_changed()
+                result = self.execute(selectsql, params).fetchone()
        
         return result
     
-    def _get_thing_by_id(self, table, id_column, id, thingclass, *thingargs):
-        row = self.execute("SELECT * FROM %(table)s WHERE %(id_column)s = :id"
-                              % {"table": table, "id_column": id_column}, {"id": id}).fetchone()
-        if row:
-            return thingclass(self, row[id_column], row, *thingargs)
+    def _catalog_changed(self):
+        self.catalog_version += 1
+        self.tracks.clear()
+        for things in self.things.itervalues():
+            things.clear()
+    
+    def _get_thing(self, thingclass, id, row):
+        """Get the shared object for an album, artist or genre, creating it from a row if necessary."""
+        if id is None:
+            return None
+        
+        things = self.things[thingclass]
+        thing = things.get(id)
+        if thing is None:
+            thing = thingclass(self, id, row)
+            things.put(id, thing)
+        return thing
+    
+    def invalidate_track(self, track_id):
+        """Drop a track from the identity map, after changing its row."""
+        self.tracks.discard(track_id)
             
     def get_artist(self, artist_name, add=False):
         row = self._get_thing_id("SELECT * FROM artist WHERE name=:name",
                                  "INSERT INTO artist (name) VALUES (:name)",
                                  add, {"name": artist_name})
         if row:
-            return Artist(self, row["artistid"], row)
+            return self._get_thing(Artist, row["artistid"], row)
     
     
     def get_album(self, album_name, add=False):
-        with self.db:
-            row = self._get_thing_id("SELECT * FROM album WHERE name=:name",
-                                     "INSERT INTO album (name) VALUES (:name)",
-                                     add, {"name": album_name})
+        row = self._get_thing_id("SELECT * FROM album WHERE name=:name",
+                                 "INSERT INTO album (name) VALUES (:name)",
+                                 add, {"name": album_name})
         if row:
-            return Album(self, row["albumid"], row)
+            return self._get_thing(Album, row["albumid"], row)
         
     def get_genre(self, genre_name, add=False):
         row = self._get_thing_id("SELECT * FROM genre WHERE name=:name",
                                  "INSERT INTO genre (name) VALUES (:name)",
                                  add, {"name": genre_name})
         if row:
-            return Genre(self, row["genreid"], row)
+            return self._get_thing(Genre, row["genreid"], row)
            
     def get_track(self, track_name, album_name, artist_name, genre_name=None, add=False):
         _log.info("Retrieving track info for \"%s\" from \"%s\" by \"%s\"...", track_name, album_name, artist_name)
@@ -137,23 +582,137 @@ class MusicDB:
                                        "now": datetime.datetime.now()})
         if row:
             _log.info("Retrieved track info for \"%s\" from \"%s\" by \"%s\" (id %s).", track_name, album_name, artist_name, row["trackid"])
-            return Track(self, row["trackid"], row, album, artist, genre)
+            track = self.tracks.get(row["trackid"])
+            if track is None:
+                track = Track(self, row["trackid"], row, album, artist, genre)
+                self.tracks.put(track.id, track)
+            return track
+        
+    def _intern_names(self, table, id_column, names):
+        """Map names to the ids of a table's rows, inserting rows for names which do not exist yet."""
+        ids = {}
+        maxid = 0
+        for id, name in self.execute("SELECT %(id_column)s, name FROM %(table)s ORDER BY %(id_column)s"
+                                     % {"table": table, "id_column": id_column}):
+            ids.setdefault(name, id)
+            maxid = id
+        
+        missing = [name for name in OrderedDict.fromkeys(names) if name not in ids]
+        if missing:
+            self.executemany("INSERT INTO %(table)s (name) VALUES (?)" % {"table": table},
+                             ((name,) for name in missing))
+            for id, name in self.execute("SELECT %(id_column)s, name FROM %(table)s WHERE %(id_column)s > :maxid"
+                                         % {"table": table, "id_column": id_column}, {"maxid": maxid}):
+                ids.setdefault(name, id)
+            self._catalog_changed()
+        
+        return ids
+    
+    def bulk_add_tracks(self, descs):
+        """Ensure that many tracks exist, returning their ids in order.
+        
+        Accepts an iterable of track descriptions, of the form
+        {"title": ..., "album": ..., "artist": ..., "genre": ...}. Album, artist and genre names are
+        interned in memory, and everything missing is inserted in batches within one transaction.
+        
+        """
+        descs = list(descs)
+        _log.info("Adding %s tracks.", len(descs))
+        
+        with self.transaction():
+            albums = self._intern_names("album", "albumid", (desc["album"] for desc in descs))
+            artists = self._intern_names("artist", "artistid", (desc["artist"] for desc in descs))
+            genres = self._intern_names("genre", "genreid", (desc["genre"] for desc in descs if desc.get("genre")))
+            
+            tracks = {}
+            maxid = 0
+            for trackid, name, albumid, artistid in self.execute("SELECT trackid, name, albumid, artistid FROM track"):
+                tracks[name, albumid, artistid] = trackid
+                maxid = max(maxid, trackid)
+            
+            keys = [(desc["title"], albums[desc["album"]], artists[desc["artist"]]) for desc in descs]
+            
+            missing = OrderedDict()
+            now = datetime.datetime.now()
+            for desc, key in izip(descs, keys):
+                if key not in tracks and key not in missing:
+                    missing[key] = key + (genres.get(desc.get("genre")), now)
+            
+            if missing:
+                self.executemany("INSERT INTO track (name, albumid, artistid, genreid, added) VALUES (?, ?, ?, ?, ?)",
+                                 missing.itervalues())
+                for trackid, name, albumid, artistid in self.execute("""
+                        SELECT trackid, name, albumid, artistid FROM track WHERE trackid > :maxid
+                        """, {"maxid": maxid}):
+                    tracks[name, albumid, artistid] = trackid
+                self._catalog_changed()
+        
+        return [tracks[key] for key in keys]
         
     def get_track_by_id(self, track_id):
+        """Get a track along with its album, artist and genre by id.
+        
+        Tracks are loaded with a single query, and shared through an identity map until they change.
+        
+        """
+        track = self.tracks.get(track_id)
+        if track is not None:
+            return track
+        
         _log.info("Retrieving track info with id %s...", track_id)
+        rows = self.query("""
+            SELECT track.*,
+                   album.name AS album_name,
+                   artist.name AS artist_name,
+                   genre.name AS genre_name
+                FROM track
+                JOIN album ON album.albumid=track.albumid
+                JOIN artist ON artist.artistid=track.artistid
+                LEFT JOIN genre ON genre.genreid=track.genreid
+                WHERE track.trackid=:id
+            """, {"id": track_id})
+        
+        if rows:
+            row = rows[0]
+            track = Track(self, row["trackid"], row,
+                          self._get_thing(Album, row["albumid"], {"albumid": row["albumid"], "name": row["album_name"]}),
+                          self._get_thing(Artist, row["artistid"], {"artistid": row["artistid"], "name": row["artist_name"]}),
+                          self._get_thing(Genre, row["genreid"], {"genreid": row["genreid"], "name": row["genre_name"]}))
+            self.tracks.put(track.id, track)
+            return track
+    
+    def load_catalog(self):
+        """Load a columnar CatalogTable of the ids of every track."""
+        catalog = CatalogTable(self)
+        catalog.load()
+        return catalog
+    
+    def record_plays(self, plays):
+        """Record many track plays at once, given a dictionary of the form { trackid: (count, lastplayed) }.
+        
+        This must be called within a transaction.
         
-        track = self._get_thing_by_id("track", "trackid", track_id, Track)
-        track.album = self._get_thing_by_id("album", "albumid", track["albumid"], Album)
-        track.artist = self._get_thing_by_id("artist", "artistid", track["artistid"], Artist)
-        track.genre = self._get_thing_by_id("genre", "genreid", track["genreid"], Genre)
-        return track
+        """
+        self.executemany("UPDATE track SET playcount=playcount+?, lastplayed=? WHERE trackid=?;",
+                         ((count, lastplayed, trackid) for trackid, (count, lastplayed) in plays.iteritems()))
+        for trackid in plays:
+            self.invalidate_track(trackid)
 
 class MusicHistory:
     def __init__(self, musicdb):
         self.musicdb = musicdb
     
     def init(self):
-        with self.musicdb.db:
+        self.musicdb.migrate("history", self.migrations())
+    
+    def migrations(self):
+        return [self._init_schema,
+                self._init_indexes,
+                self._init_historyid,
+                self._init_rollup]
+    
+    def _init_schema(self):
+        with self.musicdb.transaction():
             self.musicdb.execute("""
                 CREATE TABLE IF NOT EXISTS history (
                     timestamp TIMESTAMP PRIMARY KEY,
@@ -162,47 +721,306 @@ class MusicHistory:
                     userchoice BOOLEAN,
                     userscore INTEGER DEFAULT 0
                 )""")
+    
+    def _init_indexes(self):
+        with self.musicdb.transaction():
+            self.musicdb.execute("CREATE INDEX IF NOT EXISTS history_fromtrackid ON history (fromtrackid)")
+            self.musicdb.execute("CREATE INDEX IF NOT EXISTS history_totrackid ON history (totrackid)")
+    
+    def _init_historyid(self):
+        # Key entries by an integer id (keeping their rowids) rather than by timestamp, which
+        # collides when entries are recorded within the same microsecond. The steps are safe to
+        # run again, should an earlier attempt have been committed partway.
+        with self.musicdb.transaction():
+            if not self.musicdb.execute("PRAGMA table_info(history)").fetchall():
+                # The entries were copied, but the copy was not yet renamed
+                self.musicdb.execute("ALTER TABLE history_new RENAME TO history")
+            self.musicdb.execute("DROP TABLE IF EXISTS history_new")
             
-    def record_transition(self, fromtrackid, totrackid, userchoice):
-        with self.musicdb.db:
+            columns = [row["name"] for row in self.musicdb.execute("PRAGMA table_info(history)")]
+            if "historyid" not in columns:
+                self.musicdb.execute("""
+                    CREATE TABLE history_new (
+                        historyid INTEGER PRIMARY KEY AUTOINCREMENT,
+                        timestamp TIMESTAMP NOT NULL,
+                        fromtrackid INTEGER REFERENCES track(trackid),
+                        totrackid INTEGER REFERENCES track(trackid),
+                        userchoice BOOLEAN,
+                        userscore INTEGER DEFAULT 0
+                    )""")
+                
+                self.musicdb.execute("""
+                    INSERT
+                        INTO history_new (historyid, timestamp, fromtrackid, totrackid, userchoice, userscore)
+                        SELECT rowid, timestamp, fromtrackid, totrackid, userchoice, userscore FROM history
+                    """)
+                self.musicdb.execute("DROP TABLE history")
+                self.musicdb.execute("ALTER TABLE history_new RENAME TO history")
+            
+            self.musicdb.execute("CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp)")
+            self.musicdb.execute("CREATE INDEX IF NOT EXISTS history_fromtrackid ON history (fromtrackid)")
+            self.musicdb.execute("CREATE INDEX IF NOT EXISTS history_totrackid ON history (totrackid)")
+    
+    def _init_rollup(self):
+        # Daily counts of the transitions between each pair of tracks, for expired entries
+        with self.musicdb.transaction():
             self.musicdb.execute("""
+                CREATE TABLE IF NOT EXISTS history_daily (
+                    day DATE NOT NULL,
+                    fromtrackid INTEGER NOT NULL,
+                    totrackid INTEGER NOT NULL,
+                    transitions INTEGER DEFAULT 0,
+                    userchoices INTEGER DEFAULT 0,
+                    userscore INTEGER DEFAULT 0,
+                    PRIMARY KEY (day, fromtrackid, totrackid)
+                )""")
+            
+    def record_transition(self, fromtrackid, totrackid, userchoice):
+        """Insert a transition, returning the id of its history entry."""
+        with self.musicdb.transaction():
+            return self.musicdb.execute("""
                 INSERT
                     INTO history (timestamp, fromtrackid, totrackid, userchoice)
                     VALUES (:now, :fromtrackid, :totrackid, :userchoice)
                 """, {"fromtrackid": fromtrackid,
                       "totrackid": totrackid,
                       "userchoice": userchoice,
-                      "now": datetime.datetime.now()})
+                      "now": datetime.datetime.now()}).lastrowid
+    
+    def record_transitions(self, transitions):
+        """Insert many (timestamp, fromtrackid, totrackid, userchoice) transitions at once.
+        
+        Returns the id of the last history entry inserted. This must be called within a transaction.
+        
+        """
+        self.musicdb.executemany("""
+            INSERT
+                INTO history (timestamp, fromtrackid, totrackid, userchoice)
+                VALUES (?, ?, ?, ?)
+            """, transitions)
+        return self.musicdb.execute("SELECT last_insert_rowid()").fetchone()[0]
             
-    def record_user_feedback(self, userscore):
-        with self.musicdb.db:
-            self.musicdb.execute("""
-                UPDATE history
-                    SET userscore=:userscore
-                    WHERE timestamp=(SELECT MAX(timestamp) FROM history)
-                """, {"userscore": userscore})
+    def record_user_feedback(self, userscore, historyid=None):
+        """Set the user score of a history entry, by default the most recent one."""
+        with self.musicdb.transaction():
+            if historyid is None:
+                self.musicdb.execute("""
+                    UPDATE history
+                        SET userscore=:userscore
+                        WHERE historyid=(SELECT MAX(historyid) FROM history)
+                    """, {"userscore": userscore})
+            else:
+                self.musicdb.execute("""
+                    UPDATE history
+                        SET userscore=:userscore
+                        WHERE historyid=:historyid
+                    """, {"userscore": userscore, "historyid": historyid})
+    
+    def expire(self, before, archive_dir=None, batch_size=10000):
+        """Roll the entries recorded before a time up into daily counts, removing them from the history.
+        
+        The counts are kept in the history_daily table, by day and pair of tracks (with a fromtrackid
+        of 0 for the start of a session). When archive_dir is given, the entries are first written to
+        a gzipped CSV file there, named after the id of the first entry. Entries are expired in
+        batches of batch_size, each in a transaction of its own.
+        
+        Returns: the number of entries expired
+        
+        """
+        _log.info("Expiring history entries recorded before %s.", before)
+        
+        archive = None
+        expired = 0
+        try:
+            while True:
+                with self.musicdb.transaction():
+                    rows = self.musicdb.execute("""
+                        SELECT historyid, timestamp, fromtrackid, totrackid, userchoice, userscore
+                            FROM history
+                            WHERE timestamp < :before
+                            ORDER BY timestamp
+                            LIMIT :limit
+                        """, {"before": before, "limit": batch_size}).fetchall()
+                    if not rows:
+                        break
+                    
+                    if archive_dir:
+                        if archive is None:
+                            path = os.path.join(archive_dir, "history-%s.csv.gz" % rows[0]["historyid"])
+                            _log.info("Archiving history entries to %s.", path)
+                            archive = gzip.open(path, "wb")
+                            writer = csv.writer(archive)
+                            writer.writerow(rows[0].keys())
+                        
+                        # The entries are on disk before they are removed from the database
+                        writer.writerows(tuple(row) for row in rows)
+                        archive.flush()
+                        os.fsync(archive.fileno())
+                    
+                    rollup = {}
+                    for row in rows:
+                        key = (row["timestamp"].date(), row["fromtrackid"] or 0, row["totrackid"])
+                        counts = rollup.setdefault(key, [0, 0, 0])
+                        counts[0] += 1
+                        counts[1] += 1 if row["userchoice"] else 0
+                        counts[2] += row["userscore"] or 0
+                    
+                    self.musicdb.executemany("""
+                        INSERT
+                            INTO history_daily (day, fromtrackid, totrackid, transitions, userchoices, userscore)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (day, fromtrackid, totrackid)
+                            DO UPDATE SET transitions=transitions+excluded.transitions,
+                                          userchoices=userchoices+excluded.userchoices,
+                                          userscore=userscore+excluded.userscore
+                        """, (key + tuple(counts) for key, counts in rollup.iteritems()))
+                    self.musicdb.executemany("DELETE FROM history WHERE historyid=?",
+                                             ((row["historyid"],) for row in rows))
+                    expired += len(rows)
+        finally:
+            if archive is not None:
+                archive.close()
+        
+        _log.info("Expired %s history entries.", expired)
+        return expired
 
-class Thing:
-    def __init__(self, musicdb, id, row):
+class CatalogTable:
+    """A compact columnar copy of the track catalog, stored as parallel arrays of ids.
+    
+    Tracks are kept in order of id, and looked up by bisection rather than through a dictionary.
+    Null ids (tracks without a genre) are stored as 0.
+    
+    """
+    fields = ("trackid", "albumid", "artistid", "genreid")
+    
+    def __init__(self, musicdb):
         self.musicdb = musicdb
-        self.id = id
-        self.row = row
+        self.columns = dict((field, array.array("l")) for field in self.fields)
+        self.catalog_version = None
+        self.lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self.ids)
+    
+    def __contains__(self, trackid):
+        return self._position(trackid) is not None
+    
+    @property
+    def ids(self):
+        return self.columns["trackid"]
+    
+    def load(self):
+        _log.info("Loading track catalog table.")
+        self.columns = dict((field, array.array("l")) for field in self.fields)
+        self.catalog_version = None
+        self.sync()
+    
+    def sync(self, force=False):
+        """Load any tracks that have been added to the database since the last sync.
+        
+        Unless forced, the database is only checked when tracks were added through this MusicDB;
+        tracks added over other connections to the file are only found by forcing it.
         
+        """
+        with self.lock:
+            version = self.musicdb.catalog_version
+            if version == self.catalog_version and not force:
+                return
+            
+            rows = self.musicdb.query("""
+                SELECT trackid, albumid, artistid, genreid
+                    FROM track
+                    WHERE trackid > :maxid
+                    ORDER BY trackid
+                """, {"maxid": self.ids[-1] if self.ids else 0})
+            
+            for row in rows:
+                for field in self.fields:
+                    self.columns[field].append(row[field] or 0)
+            
+            self.catalog_version = version
+    
+    def _position(self, trackid, sync=True):
+        ids = self.ids
+        position = bisect.bisect_left(ids, trackid)
+        if position < len(ids) and ids[position] == trackid:
+            return position
+        elif sync and (self.catalog_version != self.musicdb.catalog_version or not ids or trackid > ids[-1]):
+            # The track may have been added since the last sync, through this MusicDB or over
+            # another connection (which ids after the last one loaded are looked up for)
+            self.sync(force=True)
+            return self._position(trackid, False)
+    
+    def get(self, trackid, field):
+        """Get the value of a field of a track, or None if the track is not in the catalog."""
+        position = self._position(trackid)
+        if position is not None:
+            return self.columns[field][position] or None
+    
+    def get_fields(self, trackid):
+        """Get a dictionary of the field values of a track."""
+        position = self._position(trackid)
+        if position is not None:
+            return dict((field, self.columns[field][position] or None) for field in self.fields)
+    
+    def get_track(self, trackid):
+        """Load the full Track object of a track."""
+        return self.musicdb.get_track_by_id(trackid)
+
+class Thing(object):
+    """A row of the catalog, exposing its columns by name through indexing.
+    
+    Things are immutable: when a row changes, a new object is loaded in its place.
+    
+    """
+    __slots__ = ("musicdb", "id", "values")
+    fields = ()
+    
+    def __init__(self, musicdb, id, row):
+        object.__setattr__(self, "musicdb", musicdb)
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "values", tuple(row[field] for field in self.fields))
+        
+    def __setattr__(self, name, value):
+        raise AttributeError("%s objects are immutable." % self.__class__.__name__)
+    
     def __getitem__(self, key):
-        return self.row[key]
+        return self.values[self.field_index[key]]
+    
+    def __repr__(self):
+        return "<%s %s: %r>" % (self.__class__.__name__, self.id, dict(zip(self.fields, self.values)))
 
-class Artist(Thing): pass
-class Album(Thing): pass
-class Genre(Thing): pass
+def _field_index(fields):
+    return dict((field, index) for index, field in enumerate(fields))
+
+class Artist(Thing):
+    __slots__ = ()
+    fields = ("artistid", "name")
+    field_index = _field_index(fields)
+
+class Album(Thing):
+    __slots__ = ()
+    fields = ("albumid", "name")
+    field_index = _field_index(fields)
+
+class Genre(Thing):
+    __slots__ = ()
+    fields = ("genreid", "name")
+    field_index = _field_index(fields)
 
 class Track(Thing):
+    __slots__ = ("album", "artist", "genre")
+    fields = ("trackid", "name", "albumid", "artistid", "genreid", "lastplayed", "added", "playcount")
+    field_index = _field_index(fields)
+    
     def __init__(self, musicdb, id, row, album=None, artist=None, genre=None):
         Thing.__init__(self, musicdb, id, row)
-        self.album = album
-        self.artist = artist
-        self.genre = genre
+        object.__setattr__(self, "album", album)
+        object.__setattr__(self, "artist", artist)
+        object.__setattr__(self, "genre", genre)
         
     def record_play(self):
-        with self.musicdb.db:
+        with self.musicdb.transaction():
             self.musicdb.execute("UPDATE track SET playcount=playcount+1, lastplayed=:now WHERE trackid=:id;", 
                                     {"id": self.id, "now": datetime.datetime.now()})
+        self.musicdb.invalidate_track(self.id)
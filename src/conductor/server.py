@@ -0,0 +1,289 @@
+"""A network service exposing a MarkovConductor to many listeners at once.
+
+Clients connect over a Unix or TCP socket and exchange JSON objects, one per line. A request has
+the form {"id": .., "method": .., "params": {..}} and is answered by {"id": .., "result": ..} or
+{"id": .., "error": ".."}. Each connection is a listening session of its own. The methods are:
+
+    choose_next_track    {"fromtrack": track}  (by default, the last track of the session)
+    record_transition    {"fromtrack": track, "totrack": track, "userchoice": true}
+    record_user_feedback {"liked": true}
+    touch_track          {"track": track}
+
+where a track is a dictionary with the keys "title", "album", "artist" and "genre", or null for
+the start of a session.
+
+The socket is served by an asyncore loop, while the conductor (and so SQLite) is only used by a
+pool of worker threads. The requests of one connection are answered in order, one at a time,
+while those of different connections run concurrently. Concurrent requests for the next track
+from the same track are coalesced into one job, so the transitions are scored once for all.
+
+The service is started with the path of the database, as python conductor/server.py DBPATH (or
+python -m conductor.server DBPATH); see --help for its options.
+
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import socket
+import logging
+import asyncore
+import asynchat
+import threading
+import Queue
+import json
+from collections import deque
+from optparse import OptionParser
+
+if __name__ == "__main__" and __package__ is None:
+    # Run as a script (python conductor/server.py) rather than as a module (python -m conductor.server)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conductor.engine.markov import MarkovConductor
+
+_log = logging.getLogger("conductor.server")
+
+TRACK_KEYS = ("title", "album", "artist", "genre")
+
+class ConductorServer(asyncore.dispatcher):
+    def __init__(self, conductor, address, workers=4):
+        asyncore.dispatcher.__init__(self)
+        self.conductor = conductor
+        self.address = address
+        
+        # Requests for the next track waiting on a job, by source track
+        self.pending = {}
+        
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+        self.waker = _Waker(self)
+        self.workers = [threading.Thread(target=self._work) for i in xrange(workers)]
+        
+        if isinstance(address, basestring):
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if os.path.exists(address):
+                os.unlink(address)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(128)
+    
+    def serve_forever(self):
+        _log.info("Serving conductor on %s.", self.address)
+        for worker in self.workers:
+            worker.setDaemon(True)
+            worker.start()
+        try:
+            asyncore.loop(use_poll=True)
+        finally:
+            self.shutdown()
+    
+    def shutdown(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+        self.close()
+        if isinstance(self.address, basestring) and os.path.exists(self.address):
+            os.unlink(self.address)
+    
+    def handle_accept(self):
+        pair = self.accept()
+        if pair:
+            ConductorChannel(self, pair[0])
+    
+    def submit(self, func, callback):
+        """Run a function on a worker thread, then pass its result to a callback on the loop."""
+        self.jobs.put((func, callback))
+    
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, callback = job
+            try:
+                result, error = func(), None
+            except Exception, e:
+                _log.exception("Error while handling a request.")
+                result, error = None, str(e)
+            self.results.put((callback, result, error))
+            self.waker.wake()
+    
+    def handle_results(self):
+        while True:
+            try:
+                callback, result, error = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            callback(result, error)
+    
+    def choose_next_track(self, fromtrack, callback):
+        """Pick the next track for a request, joining any job already picking from the same track."""
+        key = tuple(fromtrack[k] for k in TRACK_KEYS) if fromtrack else None
+        waiting = self.pending.get(key)
+        if waiting is not None:
+            waiting.append(callback)
+            return
+        
+        waiting = self.pending[key] = [callback]
+        
+        def choose():
+            # Any requests joining from here on are answered by this job too
+            count = len(waiting)
+            return self.conductor.choose_next_tracks(fromtrack, count)
+        
+        def answer(tracks, error):
+            del self.pending[key]
+            if error:
+                for callback in waiting:
+                    callback(None, error)
+                return
+            
+            for callback, track in zip(waiting, tracks):
+                callback(track, None)
+            
+            # Requests which joined while the tracks were being picked get one more round
+            for callback in waiting[len(tracks):]:
+                self.choose_next_track(fromtrack, callback)
+        
+        self.submit(choose, answer)
+
+class ConductorChannel(asynchat.async_chat):
+    """A client connection, holding the listening session of the client."""
+    
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock)
+        self.server = server
+        self.session = server.conductor.session()
+        self.buffer = []
+        self.set_terminator("\n")
+        
+        # Requests waiting for the current request of this client to finish
+        self.queue = deque()
+        self.busy = False
+    
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+    
+    def found_terminator(self):
+        line = "".join(self.buffer).strip()
+        self.buffer = []
+        if not line:
+            return
+        
+        try:
+            request = json.loads(line)
+            method = getattr(self, "do_" + request["method"])
+            params = request.get("params") or {}
+        except Exception:
+            request, method, params = {}, self.do_invalid, {}
+        
+        def callback(result, error):
+            if error:
+                self.respond({"id": request.get("id"), "error": error})
+            else:
+                self.respond({"id": request.get("id"), "result": result})
+        
+        self.queue.append((method, params, callback))
+        self._next()
+    
+    def _next(self):
+        if self.busy or not self.queue:
+            return
+        
+        method, params, callback = self.queue.popleft()
+        self.busy = True
+        
+        def done(result, error):
+            self.busy = False
+            callback(result, error)
+            self._next()
+        
+        try:
+            method(params, done)
+        except Exception, e:
+            done(None, str(e))
+    
+    def respond(self, response):
+        if self.connected:
+            self.push(json.dumps(response) + "\n")
+    
+    def do_invalid(self, params, callback):
+        callback(None, "Invalid request.")
+    
+    def do_choose_next_track(self, params, callback):
+        if "fromtrack" in params:
+            fromtrack = params["fromtrack"]
+        elif self.session.current_track:
+            fromtrack = self.server.conductor.get_desc(self.session.current_track)
+        else:
+            fromtrack = None
+        self.server.choose_next_track(fromtrack, callback)
+    
+    def do_record_transition(self, params, callback):
+        self.server.submit(lambda: self.session.record_transition(params.get("fromtrack"), params["totrack"],
+                                                                  params.get("userchoice", True)),
+                           callback)
+    
+    def do_record_user_feedback(self, params, callback):
+        self.server.submit(lambda: self.session.record_user_feedback(params["liked"]), callback)
+    
+    def do_touch_track(self, params, callback):
+        self.server.submit(lambda: self.server.conductor.touch_track(params["track"]), callback)
+
+class _Waker(asyncore.file_dispatcher):
+    """Wakes the asyncore loop when a worker thread has finished a job."""
+    
+    def __init__(self, server):
+        self.reader, self.writer = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.reader)
+        os.close(self.reader)
+        self.server = server
+        self.lock = threading.Lock()
+    
+    def wake(self):
+        with self.lock:
+            os.write(self.writer, "x")
+    
+    def writable(self):
+        return False
+    
+    def handle_read(self):
+        self.recv(4096)
+        self.server.handle_results()
+    
+    def handle_close(self):
+        pass
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] DBPATH")
+    parser.add_option("-s", "--socket", default="/tmp/conductor.sock",
+                      help="Unix socket path to listen on")
+    parser.add_option("-p", "--port", type="int",
+                      help="TCP port to listen on instead of a Unix socket")
+    parser.add_option("-w", "--workers", type="int", default=4,
+                      help="number of worker threads")
+    parser.add_option("-m", "--in-memory", action="store_true", default=False,
+                      help="score transitions from an in-memory model")
+    parser.add_option("-v", "--verbose", action="store_true", default=False)
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("A database path is required.")
+    
+    if options.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    
+    conductor = MarkovConductor(args[0], {"in_memory": options.in_memory,
+                                          "pool_size": options.workers})
+    conductor.load()
+    if not conductor.chains:
+        conductor.init_chain("trackid", "trackid")
+    
+    address = ("", options.port) if options.port else options.socket
+    try:
+        ConductorServer(conductor, address, options.workers).serve_forever()
+    finally:
+        conductor.unload()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,168 @@
+import sys
+sys.path.append(".")
+
+import os
+import json
+import random
+import logging
+from optparse import OptionParser
+from timeit import default_timer as timer
+
+from conductor.engine.markov import MarkovConductor
+from conductor.engine.sampler import AliasTable
+
+CHAINS = [("trackid", "trackid"),
+          ("albumid", "albumid"),
+          ("albumid", "trackid"),
+          ("albumid", "artistid"),
+          ("artistid", "artistid"),
+          ("artistid", "trackid"),
+          ("genreid", "genreid")]
+
+def generate_catalog(rng, tracks, albums, artists, genres):
+    """Generate track descriptions, with albums of consecutive tracks by the same artist."""
+    per_album = max(1, tracks // albums)
+    album_tags = {}
+    descs = []
+    for i in xrange(tracks):
+        album = min(i // per_album, albums - 1)
+        if album not in album_tags:
+            album_tags[album] = (rng.randrange(artists), rng.randrange(genres))
+        artist, genre = album_tags[album]
+        descs.append({"title":  "Track %s" % i,
+                      "album":  "Album %s" % album,
+                      "artist": "Artist %s" % artist,
+                      "genre":  "Genre %s" % genre})
+    return descs
+
+def generate_history(rng, descs, length, skew, album_play):
+    """Generate a listening history, as a list of (fromtrack, totrack, userchoice) transitions.
+    
+    The popularity of tracks follows a Zipf distribution with the given skew. After each track, the
+    listener goes on to the next track of the album with probability album_play.
+    
+    """
+    ranks = range(len(descs))
+    rng.shuffle(ranks)
+    popularity = AliasTable(dict((index, 1.0 / (rank + 1) ** skew) for index, rank in enumerate(ranks)))
+    
+    history = []
+    prev = None
+    for i in xrange(length):
+        if prev is not None and prev + 1 < len(descs) and rng.random() < album_play \
+                and descs[prev + 1]["album"] == descs[prev]["album"]:
+            cur = prev + 1
+        else:
+            cur = popularity.sample(rng)
+        history.append((descs[prev] if prev is not None else None, descs[cur], rng.random() < 0.5))
+        prev = cur
+    return history
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def summarize(latencies, elapsed=None):
+    """Summarize a list of latencies in seconds, reporting percentiles in milliseconds."""
+    latencies = sorted(latencies)
+    if elapsed is None:
+        elapsed = sum(latencies)
+    return {"count": len(latencies),
+            "seconds": elapsed,
+            "per_second": len(latencies) / elapsed if elapsed else None,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000}
+
+def measure(func, args_list):
+    latencies = []
+    for args in args_list:
+        start = timer()
+        func(*args)
+        latencies.append(timer() - start)
+    return summarize(latencies)
+
+def main(args):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--db", default="/tmp/conductor-benchmark.db",
+                      help="database path (recreated for each run)")
+    parser.add_option("--tracks", type="int", default=1000)
+    parser.add_option("--albums", type="int", help="number of albums (default: tracks / 10)")
+    parser.add_option("--artists", type="int", help="number of artists (default: tracks / 50)")
+    parser.add_option("--genres", type="int", default=20)
+    parser.add_option("--history", type="int", default=10000,
+                      help="number of transitions of listening history to import before measuring")
+    parser.add_option("--skew", type="float", default=1.1,
+                      help="Zipf exponent of track popularity")
+    parser.add_option("--album-play", type="float", default=0.6,
+                      help="probability of going on to the next track of the album")
+    parser.add_option("--picks", type="int", default=1000, help="number of track picks to measure")
+    parser.add_option("--records", type="int", default=1000, help="number of transitions to record")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--config", default="{}",
+                      help="JSON object of MarkovConductor configuration options")
+    parser.add_option("-v", "--verbose", action="store_true", default=False)
+    options, args = parser.parse_args(args)
+    
+    if options.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    
+    albums = options.albums or max(1, options.tracks // 10)
+    artists = options.artists or max(1, options.tracks // 50)
+    config = json.loads(options.config)
+    
+    rng = random.Random(options.seed)
+    descs = generate_catalog(rng, options.tracks, albums, artists, options.genres)
+    history = generate_history(rng, descs, options.history + options.records, options.skew, options.album_play)
+    warmup, records = history[:options.history], history[options.history:]
+    
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(options.db + suffix):
+            os.unlink(options.db + suffix)
+    
+    report = {"parameters": {"tracks": options.tracks,
+                             "albums": albums,
+                             "artists": artists,
+                             "genres": options.genres,
+                             "history": options.history,
+                             "skew": options.skew,
+                             "album_play": options.album_play,
+                             "seed": options.seed,
+                             "config": config}}
+    
+    c = MarkovConductor(options.db, dict(config, random_seed=options.seed))
+    c.load()
+    for fromfield, tofield in CHAINS:
+        c.init_chain(fromfield, tofield)
+    
+    start = timer()
+    trackids = c.touch_tracks(descs)
+    elapsed = timer() - start
+    report["touch_tracks"] = {"count": len(descs), "seconds": elapsed, "per_second": len(descs) / elapsed}
+    
+    start = timer()
+    c.record_transitions(warmup)
+    elapsed = timer() - start
+    report["record_transitions"] = {"count": len(warmup), "seconds": elapsed,
+                                    "per_second": len(warmup) / elapsed if elapsed else None}
+    
+    # Looking tracks up by id first loads them, then hits the identity map
+    lookups = [(rng.choice(trackids),) for i in xrange(options.picks)]
+    report["get_track_by_id"] = measure(c.musicdb.get_track_by_id, lookups)
+    
+    report["record_transition"] = measure(c.record_transition, records)
+    
+    # Pick from the popular tracks of the history, so that the transition caches are exercised
+    sources = [(rng.choice(history)[1],) for i in xrange(options.picks)]
+    report["choose_next_track"] = measure(c.choose_next_track, sources)
+    
+    report["cache_stats"] = c.cache_stats()
+    if config.get("profile"):
+        # The statements which took the most time in total
+        report["statements"] = c.musicdb.statement_stats()[:20]
+    c.unload()
+    
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
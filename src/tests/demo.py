@@ -2,10 +2,10 @@ import sys
 sys.path.append(".")
 
 import os
-import math
 import tagpy
 
 from conductor.engine.markov import MarkovConductor
+from conductor.engine.weights import calculate_weight_eager
 from utils import run_demo, read_chr, print_histogram
 
 PLAYCMD = "play -q \"%s\""
@@ -18,6 +18,7 @@ class Library:
         self.desc_fields = ["title", "album", "artist", "genre"]
     
     def load_files(self, loadpath):
+        descs = []
         for dirpath, dirnames, filenames in os.walk(loadpath):
             filenames.sort()
             for filename in filenames:
@@ -34,7 +35,9 @@ class Library:
                             "genre":  tag.genre}
                     
                     self.tracks[self._desc_to_tuple(desc)] = path
-                    self.conductor.touch_track(desc)
+                    descs.append(desc)
+        
+        self.conductor.touch_tracks(descs)
     
     def _desc_to_tuple(self, desc):
         return tuple(desc[field] for field in self.desc_fields)
@@ -60,14 +63,6 @@ class SimpleConsolePlayer:
         self.previous_track = None
         
     def init(self, music_dirs):
-        def calculate_weight_conservative(conductor, score, user_score):
-            ease = lambda x, length, height: (math.tanh(x*(math.pi/length))+1)*(height/2)
-            num_chains = len(conductor.chains)
-            return ease(user_score, 10 * num_chains, 10) * math.pow(2, score)
-        
-        def calculate_weight_eager(conductor, score, user_score):
-            return math.pow(1 + (1.0/len(conductor.chains)), user_score) * (math.sqrt(score) + 1)
-        
         self.conductor = MarkovConductor("/tmp/conductor-demo.db",
                                          {"weight_function": calculate_weight_eager})
         self.conductor.load()
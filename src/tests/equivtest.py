@@ -0,0 +1,184 @@
+"""Check that the batched and columnar paths give the same results as the scalar paths they replace.
+
+Compares, on a seeded synthetic catalog:
+  - bulk_add_tracks with adding the same tracks one at a time
+  - record_transitions with recording the same transitions one at a time
+  - the in-memory model's scores with those of the scoring query
+  - the vectorized weight functions with their scalar versions
+  - the frequencies sampled from an AliasTable with those of weighted_choice
+
+Exits with a non-zero status if any of the checks fails.
+
+"""
+import sys
+sys.path.append(".")
+
+import os
+import random
+
+from conductor import musicdb
+from conductor.engine import weights
+from conductor.engine.markov import MarkovConductor, weighted_choice
+from conductor.engine.sampler import AliasTable
+from benchmark import CHAINS, generate_catalog, generate_history
+from utils import run_demo
+
+DBPATH = "/tmp/conductor-equivtest-%s.db"
+
+def open_db(name, dbclass, *args):
+    path = DBPATH % name
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db = dbclass(path, *args)
+    db.load()
+    return db
+
+def catalog_rows(db):
+    return [tuple(row) for row in db.query("""
+        SELECT track.trackid, track.name, album.name, artist.name, genre.name
+            FROM track
+            JOIN album ON album.albumid=track.albumid
+            JOIN artist ON artist.artistid=track.artistid
+            LEFT JOIN genre ON genre.genreid=track.genreid
+            ORDER BY track.trackid
+        """)]
+
+def check_bulk_add(rng):
+    descs = generate_catalog(rng, 500, 50, 10, 5)
+    # Repeated tracks, and tracks without a genre
+    descs += [rng.choice(descs) for i in xrange(50)]
+    descs += [dict(rng.choice(descs), title="Untagged %s" % i, genre=None) for i in xrange(10)]
+    rng.shuffle(descs)
+    
+    sequential = open_db("sequential", musicdb.MusicDB)
+    ids = [sequential.get_track(desc["title"], desc["album"], desc["artist"], desc["genre"], add=True).id
+           for desc in descs]
+    bulk = open_db("bulk", musicdb.MusicDB)
+    bulk_ids = bulk.bulk_add_tracks(descs)
+    
+    same = ids == bulk_ids and catalog_rows(sequential) == catalog_rows(bulk)
+    sequential.unload()
+    bulk.unload()
+    return same
+
+def chain_rows(conductor):
+    rows = {}
+    for key, chain in conductor.chains.iteritems():
+        rows[key] = ([tuple(row) for row in conductor.musicdb.query(
+                          "SELECT %s, %s, score, userscore FROM %s ORDER BY 1, 2"
+                          % (chain.fromfield_column, chain.tofield_column, chain.table))],
+                     [tuple(row) for row in conductor.musicdb.query(
+                          "SELECT %s, maxscore FROM %s ORDER BY 1" % (chain.fromfield_column, chain.max_table))])
+    return rows
+
+def check_bulk_transitions(rng):
+    descs = generate_catalog(rng, 300, 30, 6, 4)
+    history = generate_history(rng, descs, 2000, 1.1, 0.6)
+    
+    conductors = []
+    for name in ("sequential", "bulk"):
+        c = open_db(name, MarkovConductor)
+        for fromfield, tofield in CHAINS:
+            c.init_chain(fromfield, tofield)
+        c.touch_tracks(descs)
+        conductors.append(c)
+    sequential, bulk = conductors
+    
+    for fromtrack, totrack, userchoice in history:
+        sequential.record_transition(fromtrack, totrack, userchoice)
+    bulk.record_transitions(history)
+    
+    history_sql = "SELECT fromtrackid, totrackid, userchoice FROM history ORDER BY historyid"
+    same = (chain_rows(sequential) == chain_rows(bulk)
+            and [tuple(row) for row in sequential.musicdb.query(history_sql)]
+                == [tuple(row) for row in bulk.musicdb.query(history_sql)])
+    for c in conductors:
+        c.unload()
+    return same
+
+def check_in_memory_scores(rng):
+    # Scores the history recorded by check_bulk_transitions
+    path = DBPATH % "bulk"
+    sql = MarkovConductor(path)
+    sql.load()
+    memory = MarkovConductor(path, {"in_memory": True})
+    memory.load()
+    
+    same = True
+    fromids = [None] + rng.sample(list(sql.catalog.ids), 50)
+    for fromid in fromids:
+        expected = sql.get_transitions_from_id(fromid)
+        scores = memory.get_transitions_from_id(fromid)
+        if sorted(expected) != sorted(scores) or \
+                any(abs(scores[trackid] - score) > 1e-9 * max(1, abs(score)) for trackid, score in expected.iteritems()):
+            print "  Scores from track %s differ." % fromid
+            same = False
+    sql.unload()
+    memory.unload()
+    return same
+
+def check_weights(rng):
+    class Chains:
+        chains = dict.fromkeys(CHAINS)
+    conductor = Chains()
+    
+    scores = [rng.uniform(0, len(CHAINS)) for i in xrange(1000)]
+    user_scores = [rng.randint(-10, 10) for i in xrange(1000)]
+    same = True
+    for func in (weights.calculate_weight, weights.calculate_weight_conservative, weights.calculate_weight_eager):
+        batch = func(conductor, scores, user_scores)
+        for weight, score, user_score in zip(batch, scores, user_scores):
+            expected = func.scalar(conductor, score, user_score)
+            if abs(weight - expected) > 1e-9 * max(1, abs(expected)):
+                print "  %s(%s, %s): %s instead of %s" % (func.__name__, score, user_score, weight, expected)
+                same = False
+                break
+    return same
+
+def check_alias_sampling(rng, samples=200000, tolerance=0.005):
+    weight_dict = dict((id, rng.expovariate(1)) for id in xrange(30))
+    total = sum(weight_dict.values())
+    table = AliasTable(weight_dict)
+    
+    alias_counts = dict.fromkeys(weight_dict, 0)
+    choice_counts = dict.fromkeys(weight_dict, 0)
+    for i in xrange(samples):
+        alias_counts[table.sample(rng)] += 1
+        choice_counts[weighted_choice(weight_dict, rng)] += 1
+    
+    same = True
+    for id, weight in weight_dict.iteritems():
+        expected = weight / total
+        alias = float(alias_counts[id]) / samples
+        choice = float(choice_counts[id]) / samples
+        if abs(alias - expected) > tolerance or abs(alias - choice) > 2 * tolerance:
+            print "  Item %s: sampled %.4f by alias table, %.4f by weighted_choice; expected %.4f" % (id, alias, choice, expected)
+            same = False
+    return same
+
+CHECKS = [("bulk_add_tracks", check_bulk_add),
+          ("record_transitions", check_bulk_transitions),
+          ("in-memory scores", check_in_memory_scores),
+          ("batch weights", check_weights),
+          ("alias sampling", check_alias_sampling)]
+
+def main(args):
+    seed = int(args[0]) if args else 0
+    
+    failed = []
+    for name, check in CHECKS:
+        print "Checking %s..." % name
+        if check(random.Random(seed)):
+            print "  Same results."
+        else:
+            failed.append(name)
+    
+    print
+    if failed:
+        print "Differences found in: %s" % ", ".join(failed)
+        sys.exit(1)
+    print "All paths agree."
+
+if __name__ == "__main__":
+    run_demo(main)
@@ -9,14 +9,15 @@ from utils import run_demo, read_chr, print_histogram
 PLAYCMD = "play -q %s trim 0.1 fade 0 .5 .75"
 
 def load_files(c, path):
+    tracks = []
     for filename in os.listdir(path):
         ext = os.path.splitext(filename)[1]
         if ext in (".wav", ".mp3", ".ogg"):
-            track = {"title":  filename,
-                     "album":  "Test",
-                     "artist": "Tester",
-                     "genre":  "Sample"}
-            c.touch_track(track)
+            tracks.append({"title":  filename,
+                           "album":  "Test",
+                           "artist": "Tester",
+                           "genre":  "Sample"})
+    c.touch_tracks(tracks)
 
 def main(args):
     sample_path = args[0]